@@ -12,45 +12,68 @@
 # Licence:
 # -------------------------------------------------------------------------------
 
-from arcpy import GetParameterAsText, AddMessage
+from arcpy import GetParameterAsText, GetArgumentCount, AddMessage
 from arcpy.management import CreateMosaicDataset, AddRastersToMosaicDataset, CalculateStatistics, GetRasterProperties, \
     SetMosaicDatasetProperties
 from arcpy.mp import ArcGISProject
+from run_metrics import RunRecord, describe_record, folder_size
+from glob import glob
 import os
 
-inTileFolder = GetParameterAsText(0)
-gdb = GetParameterAsText(1)
-spatialRef = GetParameterAsText(2)
-mosaicName = GetParameterAsText(3)
-
-# Create mosaic dataset
-CreateMosaicDataset(gdb, mosaicName, spatialRef, None, "32_BIT_FLOAT", "CUSTOM", None)
-mosaicDS = os.path.join(gdb, mosaicName)
-AddMessage('Mosaic dataset {} created...'.format(mosaicName))
-
-# Add rasters to mosaic and set cell size
-AddMessage('Adding rasters to mosaic dataset...')
-AddRastersToMosaicDataset(mosaicDS, "Raster Dataset", inTileFolder,
-                          "UPDATE_CELL_SIZES", "UPDATE_BOUNDARY", "NO_OVERVIEWS", None, 0, 1500,
-                          None, None, "SUBFOLDERS", "ALLOW_DUPLICATES", "NO_PYRAMIDS", "NO_STATISTICS",
-                          "NO_THUMBNAILS", None, "NO_FORCE_SPATIAL_REFERENCE", "NO_STATISTICS", None)
-
-AddMessage('Calculating Statistics...')
-CalculateStatistics(mosaicDS, 1, 1, [], "OVERWRITE")
-
-# Update mosaic cell size
-AddMessage('Updating mosaic cell size...')
-cellSize = GetRasterProperties(mosaicDS, "CELLSIZEX")
-newSize = float(float(cellSize.getOutput(0))/2)
-SetMosaicDatasetProperties(mosaicDS, cell_size=newSize)
-
-# Add results to the display
-AddMessage('Adding results to map views...')
-aprx = ArcGISProject("CURRENT")
-for m in aprx.listMaps():
-    if m.mapType == "MAP":
-        m.addDataFromPath(mosaicDS)
-    elif m.mapType == "SCENE":
-        m.addDataFromPath(mosaicDS)
-
-AddMessage("Process complete")
+
+def main(parameters):
+    # Unset optional parameters arrive as empty text
+    parameters = list(parameters) + [''] * (5 - len(parameters))
+    inTileFolder = parameters[0]
+    gdb = parameters[1]
+    spatialRef = parameters[2]
+    mosaicName = parameters[3]
+    # Optional, defaults to <mosaic name>_run_record.json next to the geodatabase
+    runRecordFile = parameters[4] or os.path.join(os.path.dirname(gdb), '{}_run_record.json'.format(mosaicName))
+    record = RunRecord('CreateSurfaceRasterMosaic').start()
+
+    # Create mosaic dataset
+    with record.stage('create'):
+        CreateMosaicDataset(gdb, mosaicName, spatialRef, None, "32_BIT_FLOAT", "CUSTOM", None)
+    mosaicDS = os.path.join(gdb, mosaicName)
+    AddMessage('Mosaic dataset {} created...'.format(mosaicName))
+
+    # Add rasters to mosaic and set cell size
+    AddMessage('Adding rasters to mosaic dataset...')
+    with record.stage('add_rasters') as totals:
+        AddRastersToMosaicDataset(mosaicDS, "Raster Dataset", inTileFolder,
+                                  "UPDATE_CELL_SIZES", "UPDATE_BOUNDARY", "NO_OVERVIEWS", None, 0, 1500,
+                                  None, None, "SUBFOLDERS", "ALLOW_DUPLICATES", "NO_PYRAMIDS", "NO_STATISTICS",
+                                  "NO_THUMBNAILS", None, "NO_FORCE_SPATIAL_REFERENCE", "NO_STATISTICS", None)
+        rasters = glob(os.path.join(inTileFolder, '**', '*.tif'), recursive=True)
+        totals['items'] = len(rasters)
+        totals['bytes'] = sum(os.path.getsize(f) for f in rasters)
+
+    AddMessage('Calculating Statistics...')
+    with record.stage('statistics') as totals:
+        CalculateStatistics(mosaicDS, 1, 1, [], "OVERWRITE")
+        totals['bytes'] = folder_size(gdb)
+
+    # Update mosaic cell size
+    AddMessage('Updating mosaic cell size...')
+    cellSize = GetRasterProperties(mosaicDS, "CELLSIZEX")
+    newSize = float(float(cellSize.getOutput(0))/2)
+    SetMosaicDatasetProperties(mosaicDS, cell_size=newSize)
+
+    # Add results to the display
+    AddMessage('Adding results to map views...')
+    aprx = ArcGISProject("CURRENT")
+    for m in aprx.listMaps():
+        if m.mapType == "MAP":
+            m.addDataFromPath(mosaicDS)
+        elif m.mapType == "SCENE":
+            m.addDataFromPath(mosaicDS)
+
+    for line in describe_record(record.finish(runRecordFile)):
+        AddMessage(line)
+
+    AddMessage("Process complete")
+
+
+if __name__ == "__main__":
+    main([GetParameterAsText(i) for i in range(GetArgumentCount())])
@@ -12,18 +12,26 @@
 # -------------------------------------------------------------------------------
 
 from arcpy import Describe, AddError, AddMessage, Exists, da, env, SetProgressor, SetProgressorLabel, \
-    SetProgressorPosition, ResetProgressor, GetParameterAsText, CheckExtension, CheckOutExtension, CheckInExtension, \
-    ExecuteError, GetMessages
+    SetProgressorPosition, ResetProgressor, GetParameterAsText, GetArgumentCount, CheckExtension, CheckOutExtension, \
+    CheckInExtension, ExecuteError, GetMessages, NumPyArrayToRaster, Point
 from arcpy.analysis import Buffer
 from arcpy.management import LasDatasetStatistics, CreateFileGDB, Delete
 from arcpy.conversion import LasDatasetToRaster
 from arcpy.ddd import PointFileInformation
-from os.path import join, splitext, exists
+from os.path import join, splitext, exists, basename, getsize
 from os import makedirs, remove
-from math import ceil
+from math import ceil, floor
+from importlib.util import find_spec
+from point_cache import PointCache, bin_elevation, mean_elevation_grid, fill_voids_linear
+from las_lib import parse_las_files_statistics
+from pipeline_lib import StageMetrics, staged_reads, describe_stages, prefetch_files
+from run_metrics import RunRecord, describe_record
+from glob import glob
 
 env.overwriteOutput = True
 
+PAGE_BYTES = 4096
+
 # error classes
 
 
@@ -42,17 +50,10 @@ class LicenseError(Exception):
 def get_las_tiles_from_lasd(in_lasd):
     temp_file = f'{Describe(in_lasd).path}\\las_stats_temp.txt'
     LasDatasetStatistics(in_lasd, "SKIP_EXISTING_STATS", temp_file, "LAS_FILES", "COMMA", "DECIMAL_POINT")
-    las_list = []
-    count = 0
     with open(temp_file) as f:
-        for line in f:
-            if count > 1:
-                las_file = line.strip().split(",")[0]
-                if las_file not in las_list:
-                    las_list.append(las_file)
-            count += 1
+        las_list = parse_las_files_statistics(f)
     remove(temp_file)
-    return [x for x in las_list if x]
+    return las_list
 
 
 def unitsCalc(inFeature):
@@ -111,25 +112,91 @@ def createLasFootprints(filesToProcess, lasExtent, suffix, spatialRef, lasExtent
     return
 
 
+def readCachedPoints(cache, lasHeaders, bounds):
+    """Map the cached point columns of every tile overlapping the bounds and fault their pages into the OS file
+    cache, without copying them. Neighbouring rasters map the same columns again and find them cached."""
+    xMin, yMin, xMax, yMax = bounds
+    tilePoints = []
+    for lasFile, header in lasHeaders.items():
+        bXMin, bYMin, bXMax, bYMax = header["bounds"][:4]
+        if bXMin > xMax or bXMax < xMin or bYMin > yMax or bYMax < yMin:
+            continue
+        points = cache.columns(lasFile, ("x", "y", "z", "withheld"))
+        for values in points.values():
+            values[::max(1, PAGE_BYTES // values.itemsize)].sum()  # Reads one element of every page
+        tilePoints.append(points)
+    return tilePoints, sum(v.nbytes for points in tilePoints for v in points.values())
+
+
+def createRasterFromCache(tilePoints, extent, outRaster):
+    """Create DEM Raster by binning the cached point columns of every tile overlapping the extent, with the
+    BINNING AVERAGE LINEAR interpolation LasDatasetToRaster uses by default"""
+    cell = float(cellSize)
+    # Align the grid to multiples of the cell size so neighbouring tiles snap to each other
+    xMin = floor(extent.XMin / cell) * cell
+    yMax = ceil(extent.YMax / cell) * cell
+    nCols = ceil((extent.XMax - xMin) / cell)
+    nRows = ceil((yMax - extent.YMin) / cell)
+    sums = counts = 0
+    for points in tilePoints:
+        tileSums, tileCounts = bin_elevation(points["x"], points["y"], points["z"], xMin, yMax, cell, nCols, nRows,
+                                             points["withheld"])
+        sums = sums + tileSums
+        counts = counts + tileCounts
+    grid = fill_voids_linear(mean_elevation_grid(sums, counts, nCols, nRows))
+    NumPyArrayToRaster(grid, Point(xMin, yMax - nRows * cell), cell, cell, -9999).save(outRaster)
+    return
+
+
 def createRasters(lasExtentBuff, RasterFolder, filesToProcess):
     """Create DEM Raster"""
     AddMessage('Creating Raster Tile data...')
-    with da.UpdateCursor(lasExtentBuff, ["FileName", "shape@"]) as cursor:
-        for i, row in enumerate(cursor):
-            fileName = splitext(row[0])[0]
-            env.extent = row[1].extent
+    cache = None
+    lasHeaders = {}
+    if pointCacheFolder and not find_spec('scipy'):
+        AddMessage('scipy is not available to fill voids like LasDatasetToRaster, the point cache is not used')
+    elif pointCacheFolder:
+        # Uncompressed LAS tiles are gridded from the columnar point cache, other formats use the lasd
+        cache = PointCache(pointCacheFolder, float(pointCacheSizeGB) * 1024 ** 3)
+        lasHeaders = {f: cache.header(f) for f in filesToProcess if cache.supports(f)}
+        AddMessage('Using point cache {0} for {1} of {2} tiles'.format(pointCacheFolder, len(lasHeaders),
+                                                                       len(filesToProcess)))
+    useCache = bool(lasHeaders) and len(lasHeaders) == len(filesToProcess)
+    lasPaths = {splitext(basename(f))[0]: f for f in filesToProcess}
+
+    def readTile(tile):
+        """Read stage, runs ahead of the rasterization on a background thread"""
+        fileName, extent, bounds = tile
+        if useCache:
+            return readCachedPoints(cache, lasHeaders, bounds)
+        return prefetch_files([lasPaths.get(fileName)])
+
+    metrics = StageMetrics()
+    with da.SearchCursor(lasExtentBuff, ["FileName", "shape@"]) as cursor:
+        tiles = ((splitext(row[0])[0], row[1].extent) for row in cursor)
+        tiles = ((fileName, extent, (extent.XMin, extent.YMin, extent.XMax, extent.YMax)) for fileName, extent in tiles)
+        for i, (tile, tilePoints) in enumerate(staged_reads(tiles, readTile, metrics)):
+            fileName, extent, bounds = tile
+            env.extent = extent
             # Create DEM
             outRaster = join(RasterFolder, '{0}_{1}.tif'.format(rasterName, fileName))
             AddMessage('    Creating {0} {1} of {2}  ({3})'.format(rasterName, i + 1, len(filesToProcess),
                                                                          fileName))
-            LasDatasetToRaster(inLasDataset, outRaster, "ELEVATION", None, "FLOAT", "CELLSIZE", cellSize, 1)
-            env.snapRaster = outRaster
+            if useCache:
+                createRasterFromCache(tilePoints, extent, outRaster)
+            else:
+                LasDatasetToRaster(inLasDataset, outRaster, "ELEVATION", None, "FLOAT", "CELLSIZE", cellSize, 1)
+                env.snapRaster = outRaster
             SetProgressorPosition()
-    return
+    summary = metrics.summary()
+    for line in describe_stages(summary):
+        AddMessage(line)
+    return summary
 
 
 def main_op():
     ext_list = ["3D"]
+    record = RunRecord('CreateSurfaceRasterTilesFromLiDAR', exclude=[pointCacheFolder]).start()
     try:
         for ext in ext_list:
             if CheckExtension(ext) == "Available":
@@ -165,6 +232,7 @@ def main_op():
         else:
             # Process the LAS files
             spatialRef = Describe(inLasDataset).SpatialReference
+            env.outputCoordinateSystem = spatialRef  # Applies to rasters gridded from the point cache
             filesToProcess = las_files
             suffix = splitext(fileNames[0])[1].replace('.', '')
 
@@ -179,11 +247,19 @@ def main_op():
             SetProgressor('step', 'Processing Files...', 0, processingSteps, 1)
 
             SetProgressorLabel('Creating footprints')
-            createLasFootprints(filesToProcess, lasExtent, suffix, spatialRef, lasExtentBuff)
+            with record.stage('footprints') as totals:
+                createLasFootprints(filesToProcess, lasExtent, suffix, spatialRef, lasExtentBuff)
+                totals['items'] = len(filesToProcess)
             SetProgressorPosition()
 
             SetProgressorLabel('Creating Rasters')
-            createRasters(lasExtentBuff, RasterFolder, filesToProcess)
+            with record.stage('rasters') as totals:
+                record.add_pipeline(createRasters(lasExtentBuff, RasterFolder, filesToProcess))
+                rasters = glob(join(RasterFolder, '{0}_*.tif'.format(rasterName)))
+                totals['points'] = Describe(inLasDataset).pointCount
+                totals['bytes'] = sum(getsize(f) for f in rasters)
+                totals['items'] = len(rasters)
+            record.add('points_read', totals['points'])
 
         ResetProgressor()
         AddMessage('Script Complete')
@@ -196,14 +272,29 @@ def main_op():
 
     finally:
         [CheckInExtension(ext) for ext in ext_list]
+        recordFile = runRecordFile
+        if not recordFile and exists(outFolder):
+            recordFile = join(outFolder, 'run_record.json')
+        runRecord = record.finish(recordFile)
+        for line in describe_record(runRecord):
+            AddMessage(line)
+
+
+def main(parameters):
+    """Set the tool inputs from their text values and create the rasters"""
+    global inLasDataset, outFolder, cellSize, rasterName, pointCacheFolder, pointCacheSizeGB, runRecordFile
+    parameters = list(parameters) + [''] * (7 - len(parameters))
+    inLasDataset = parameters[0]
+    outFolder = parameters[1]
+    cellSize = parameters[2]
+    rasterName = parameters[3]
+    pointCacheFolder = parameters[4]  # Optional, enables the columnar point cache
+    pointCacheSizeGB = parameters[5] or 50
+    runRecordFile = parameters[6]  # Optional, defaults to run_record.json in the output folder
+    main_op()
 
 
 if __name__ == "__main__":
 
     # Capture input; create outFolder
-    inLasDataset = GetParameterAsText(0)
-    outFolder = GetParameterAsText(1)
-    cellSize = GetParameterAsText(2)
-    rasterName = GetParameterAsText(3)
-
-    main_op()
+    main([GetParameterAsText(i) for i in range(GetArgumentCount())])
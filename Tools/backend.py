@@ -0,0 +1,329 @@
+from glob import glob
+from importlib import import_module
+from importlib.util import find_spec
+from os import environ, remove
+from os.path import basename, isdir, isfile, exists as path_exists, join, normcase, normpath, split, splitext
+from shutil import rmtree
+from sys import stderr
+from types import SimpleNamespace
+from point_cache import read_las_header, read_las_records, read_las_spatial_reference, write_las_subset
+import numpy as np
+
+# The ArcGIS operations the tools rely on, behind a backend selected on first use. Importing arcpy takes seconds, so
+# the arcpy backend only imports it when an operation is first called and pure Python paths (point cache, shard
+# coordination, planning helpers) start without it. The local backend runs the same operations without ArcGIS: it
+# describes and clips uncompressed .las files natively and keeps polygon feature classes in memory. LAS datasets
+# (.lasd) are an ArcGIS format, so creating them and computing their statistics needs the arcpy backend.
+# Set NEARMAP_BACKEND to "arcpy" or "local" to override the default, which is arcpy when it is installed.
+
+
+class ArcpyBackend:
+    name = "arcpy"
+
+    @staticmethod
+    def _module(name="arcpy"):
+        return import_module(name)
+
+    def add_message(self, message):
+        self._module().AddMessage(message)
+
+    def add_error(self, message):
+        self._module().AddError(message)
+
+    def describe(self, dataset):
+        return self._module().Describe(dataset)
+
+    def exists(self, dataset):
+        return self._module().Exists(dataset)
+
+    def delete(self, dataset):
+        self._module("arcpy.management").Delete(dataset)
+
+    def search_cursor(self, table, fields, **kwargs):
+        return self._module("arcpy.da").SearchCursor(table, fields, **kwargs)
+
+    def insert_cursor(self, table, fields):
+        return self._module("arcpy.da").InsertCursor(table, fields)
+
+    def create_feature_class(self, out_path, out_name, geometry_type, spatial_reference, has_z=False):
+        self._module("arcpy.management").CreateFeatureclass(
+            out_path, out_name, geometry_type, None, "DISABLED", "ENABLED" if has_z else "DISABLED",
+            spatial_reference, '', 0, 0, 0, out_name.replace(".shp", ""))
+        return join(out_path, out_name)
+
+    def add_field(self, table, field_name, field_type):
+        self._module("arcpy.management").AddField(table, field_name, field_type, None, None, None, '', "NON_NULLABLE",
+                                                  "NON_REQUIRED", '')
+
+    def polygon(self, rings, spatial_reference):
+        arcpy = self._module()
+        return arcpy.Polygon(arcpy.Array([arcpy.Array([arcpy.Point(x, y) for x, y in ring]) for ring in rings]),
+                             spatial_reference)
+
+    def create_las_dataset(self, files_list, out_lasd, spatial_reference, compute_stats=True):
+        self._module("arcpy.management").CreateLasDataset(
+            files_list, out_lasd, "NO_RECURSION", None, spatial_reference,
+            "COMPUTE_STATS" if compute_stats else "NO_COMPUTE_STATS", "ABSOLUTE_PATHS", "NO_FILES")
+        return out_lasd
+
+    def extract_las(self, in_las, target_folder, boundary, name_suffix, rearrange_points=True,
+                    compression="SAME_AS_INPUT"):
+        self._module("arcpy.ddd").ExtractLas(
+            in_las, target_folder, "DEFAULT", boundary, "PROCESS_EXTENT", name_suffix, "REMOVE_VLR",
+            "REARRANGE_POINTS" if rearrange_points else "NO_REARRANGE_POINTS", "COMPUTE_STATS", None, compression)
+
+    def las_dataset_statistics(self, in_lasd, out_file=None):
+        # Only computes statistics for files without them. With out_file a per file summary is written as csv.
+        if out_file:
+            self._module("arcpy.management").LasDatasetStatistics(in_lasd, "SKIP_EXISTING_STATS", out_file,
+                                                                  "LAS_FILES", "COMMA", "DECIMAL_POINT")
+        else:
+            self._module("arcpy.management").LasDatasetStatistics(in_lasd, "SKIP_EXISTING_STATS")
+
+
+def _extent(x_min, y_min, x_max, y_max, z_min=None, z_max=None):
+    return SimpleNamespace(XMin=x_min, YMin=y_min, XMax=x_max, YMax=y_max, ZMin=z_min, ZMax=z_max)
+
+
+def _spatial_reference(system):
+    # Stand-in for arcpy.SpatialReference from the system read_las_spatial_reference found, unknown when it is None
+    system = dict(system or {"name": "Unknown", "factoryCode": 0, "linearUnitName": "", "VCS": None})
+    vertical = system.pop("VCS") or {"name": "", "factoryCode": 0, "linearUnitName": ""}
+    return SimpleNamespace(**system, VCS=SimpleNamespace(**vertical))
+
+
+class LocalPolygon:
+    """Polygon of one or more rings with the arcpy.Polygon attributes the libraries read"""
+
+    def __init__(self, rings, spatial_reference=None):
+        self.rings = [[(float(x), float(y)) for x, y in ring] for ring in rings]
+        self.spatialReference = spatial_reference
+        self.pointCount = sum(len(ring) for ring in self.rings)
+        x = [x for ring in self.rings for x, _ in ring]
+        y = [y for ring in self.rings for _, y in ring]
+        self.extent = _extent(min(x), min(y), max(x), max(y)) if x else None
+
+    def contains(self, x, y):
+        # Even-odd rule over the edges of every ring, for arrays of coordinates. A point on an edge shared by two
+        # polygons is inside only one of them, so clipping a tile grid does not duplicate points.
+        inside = np.zeros(np.shape(x), dtype=bool)
+        for ring in self.rings:
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                if y1 != y2:
+                    inside ^= ((y1 > y) != (y2 > y)) & (x < x1 + (y - y1) * (x2 - x1) / (y2 - y1))
+        return inside
+
+
+class LocalTable:
+    def __init__(self, spatial_reference, fields):
+        self.spatialReference = spatial_reference
+        self.fields = list(fields)
+        self.rows = []
+
+    def check_fields(self, fields):
+        missing = [f for f in fields if f not in self.fields]
+        if missing:
+            raise RuntimeError(f"Cannot find field '{missing[0]}'")
+
+
+class LocalCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class LocalSearchCursor(LocalCursor):
+    def __init__(self, table, fields):
+        table.check_fields(fields)
+        self._rows = iter([tuple(row.get(f) for f in fields) for row in table.rows])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._rows)
+
+
+class LocalInsertCursor(LocalCursor):
+    def __init__(self, table, fields):
+        table.check_fields(fields)
+        self.table = table
+        self.fields = list(fields)
+
+    def insertRow(self, values):
+        row = dict(zip(self.fields, values))
+        shape = row.get("SHAPE@")
+        if shape is not None and not isinstance(shape, LocalPolygon):  # A ring of (x, y) coordinates
+            row["SHAPE@"] = LocalPolygon([shape], self.table.spatialReference)
+        self.table.rows.append(row)
+        return len(self.table.rows)
+
+
+class LocalBackend:
+    name = "local"
+
+    def __init__(self):
+        self._tables = {}  # Polygon feature classes by path, kept for the life of the process
+
+    def _table(self, table):
+        try:
+            return self._tables[normcase(normpath(table))]
+        except KeyError:
+            raise RuntimeError(f"Cannot open '{table}'") from None
+
+    def add_message(self, message):
+        print(message)
+
+    def add_error(self, message):
+        print(f"ERROR: {message}", file=stderr)
+
+    def describe(self, dataset):
+        path, name = split(dataset)
+        if normcase(normpath(dataset)) in self._tables:
+            table = self._table(dataset)
+            extents = [row["SHAPE@"].extent for row in table.rows if row.get("SHAPE@")]
+            extent = _extent(min(e.XMin for e in extents), min(e.YMin for e in extents),
+                             max(e.XMax for e in extents), max(e.YMax for e in extents)) if extents else None
+            return SimpleNamespace(path=path, name=name, catalogPath=dataset, dataType="FeatureClass",
+                                   shapeType="Polygon", spatialReference=table.spatialReference, extent=extent,
+                                   fields=[SimpleNamespace(name=f) for f in table.fields if not f.startswith("SHAPE@")])
+        header = read_las_header(dataset) if isfile(dataset) else None
+        if header:
+            min_x, min_y, max_x, max_y, min_z, max_z = header["bounds"]
+            return SimpleNamespace(path=path, name=name, catalogPath=dataset, dataType="File",
+                                   extent=_extent(min_x, min_y, max_x, max_y, min_z, max_z),
+                                   spatialReference=_spatial_reference(read_las_spatial_reference(dataset, header)),
+                                   pointCount=header["point_count"])
+        if path_exists(dataset):
+            return SimpleNamespace(path=path, name=name, catalogPath=dataset,
+                                   dataType="Folder" if isdir(dataset) else "File")
+        raise OSError(f'"{dataset}" does not exist')
+
+    def exists(self, dataset):
+        return normcase(normpath(dataset)) in self._tables or path_exists(dataset)
+
+    def delete(self, dataset):
+        if self._tables.pop(normcase(normpath(dataset)), None):
+            return
+        if isdir(dataset):
+            rmtree(dataset)
+        elif path_exists(dataset):
+            remove(dataset)
+
+    def search_cursor(self, table, fields):
+        return LocalSearchCursor(self._table(table), fields)
+
+    def insert_cursor(self, table, fields):
+        return LocalInsertCursor(self._table(table), fields)
+
+    def create_feature_class(self, out_path, out_name, geometry_type, spatial_reference, has_z=False):
+        if geometry_type.upper() != "POLYGON":
+            raise ValueError(f"The local backend stores polygon feature classes, not {geometry_type}")
+        out_fc = join(out_path, out_name)
+        fields = ["SHAPE@", "SHAPE@Z"] if has_z else ["SHAPE@"]
+        if out_name.endswith(".shp"):  # Shapefiles are created with an Id field
+            fields.append("Id")
+        self._tables[normcase(normpath(out_fc))] = LocalTable(spatial_reference, fields)
+        return out_fc
+
+    def add_field(self, table, field_name, field_type):
+        table = self._table(table)
+        if field_name not in table.fields:
+            table.fields.append(field_name)
+
+    def polygon(self, rings, spatial_reference):
+        return LocalPolygon(rings, spatial_reference)
+
+    def extract_las(self, in_las, target_folder, boundary, name_suffix, rearrange_points=True,
+                    compression="SAME_AS_INPUT"):
+        # Reads .las files rather than a LAS dataset, which is an ArcGIS format. Points keep their order in the file
+        # and the output is uncompressed like the input.
+        if isinstance(in_las, str):
+            in_las = sorted(glob(join(in_las, "*.las"))) if isdir(in_las) else [in_las]
+        for las_file in in_las:
+            if las_file.lower().endswith(".lasd"):
+                raise ValueError(f"The local backend reads .las files, not the LAS dataset {las_file}")
+            header = read_las_header(las_file)
+            records = read_las_records(las_file, header)
+            if records is None:
+                raise ValueError(f"The local backend can not read the compressed file {las_file}")
+            min_x, min_y, max_x, max_y = header["bounds"][:4]
+            extent = boundary.extent
+            if min_x > extent.XMax or max_x < extent.XMin or min_y > extent.YMax or max_y < extent.YMin:
+                continue
+            (scale_x, scale_y, _), (offset_x, offset_y, _) = header["scale"], header["offset"]
+            inside = boundary.contains(records["X"] * scale_x + offset_x, records["Y"] * scale_y + offset_y)
+            del records
+            if inside.any():
+                out_las = join(target_folder, f"{splitext(basename(las_file))[0]}_{name_suffix}.las")
+                write_las_subset(las_file, out_las, lambda records, header: inside)
+
+
+BACKENDS = {"arcpy": ArcpyBackend, "local": LocalBackend}
+_backend = None
+
+
+def set_backend(name):
+    global _backend
+    _backend = BACKENDS[name]()
+    return _backend
+
+
+def get_backend():
+    if _backend is None:
+        set_backend(environ.get("NEARMAP_BACKEND") or ("arcpy" if find_spec("arcpy") else "local"))
+    return _backend
+
+
+def add_message(message):
+    get_backend().add_message(message)
+
+
+def add_error(message):
+    get_backend().add_error(message)
+
+
+def describe(dataset):
+    return get_backend().describe(dataset)
+
+
+def exists(dataset):
+    return get_backend().exists(dataset)
+
+
+def delete(dataset):
+    get_backend().delete(dataset)
+
+
+def search_cursor(table, fields, **kwargs):
+    return get_backend().search_cursor(table, fields, **kwargs)
+
+
+def insert_cursor(table, fields):
+    return get_backend().insert_cursor(table, fields)
+
+
+def create_feature_class(out_path, out_name, geometry_type, spatial_reference, has_z=False):
+    return get_backend().create_feature_class(out_path, out_name, geometry_type, spatial_reference, has_z)
+
+
+def add_field(table, field_name, field_type):
+    get_backend().add_field(table, field_name, field_type)
+
+
+def polygon(rings, spatial_reference):
+    return get_backend().polygon(rings, spatial_reference)
+
+
+def create_las_dataset(files_list, out_lasd, spatial_reference, compute_stats=True):
+    return get_backend().create_las_dataset(files_list, out_lasd, spatial_reference, compute_stats)
+
+
+def las_dataset_statistics(in_lasd, out_file=None):
+    get_backend().las_dataset_statistics(in_lasd, out_file)
+
+
+def extract_las(in_las, target_folder, boundary, name_suffix, rearrange_points=True, compression="SAME_AS_INPUT"):
+    get_backend().extract_las(in_las, target_folder, boundary, name_suffix, rearrange_points, compression)
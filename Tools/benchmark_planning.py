@@ -0,0 +1,113 @@
+# -------------------------------------------------------------------------------
+# Name:        benchmark_planning.py
+# Purpose:     Time the pointcloud updater planning bookkeeping on synthetic tile catalogs
+#
+# Usage:       python benchmark_planning.py [tile counts ...]
+#
+# arcpy is not required. Only the pure helpers the planning code calls are measured, on synthetic inputs standing in
+# for what the cursors return, plus unique_values reading a feature class through the local backend. The planning
+# path itself (Dissolve, Intersect, Union and the arcpy cursors of generate_pointcloud_cookie_cutter) needs ArcGIS and
+# is not timed. Each step is timed at every catalog size and the scaling exponent is fitted on a log-log scale: close
+# to 1 is linear, close to 2 is quadratic.
+# -------------------------------------------------------------------------------
+
+from math import log, sqrt
+from sys import argv
+from time import perf_counter
+from types import SimpleNamespace
+import numpy as np
+
+from backend import set_backend, create_feature_class, add_field, insert_cursor
+from common_lib import extents_bounds, grid_bounds, quadtree_bounds, splits_for_target, tile_status, tiles_to_retile, \
+    unique_values
+from las_lib import parse_las_files_statistics
+from shard_lib import split_tile_ids
+
+CLASS_CODES = 8  # Rows per las file in a LAS_FILES statistics report
+SAMPLES_PER_TILE = 20
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+def stats_report(num_tiles):
+    lines = ["Statistics\n", "File_Name,Class,Count\n"]
+    lines += [f"D:\\lidar\\tile_{n}.las,{c},1000\n" for n in range(num_tiles) for c in range(CLASS_CODES)]
+    return lines
+
+
+def tile_paths(num_tiles):
+    return [f"D:\\lidar\\tile_{n}.las" for n in range(num_tiles)]
+
+
+def flag_tiles(paths):
+    # STATUS of every source tile, a third of them updated, as in generate_pointcloud_cookie_cutter
+    updated_paths = set(paths[::3])
+    return [tile_status(path, updated_paths) for path in paths]
+
+
+def tile_extents(num_tiles):
+    return [SimpleNamespace(XMin=1000 * (n % 100), YMin=1000 * (n // 100), XMax=1000 * (n % 100 + 1),
+                            YMax=1000 * (n // 100 + 1)) for n in range(num_tiles)]
+
+
+def tile_extents_fc(num_tiles):
+    # Source tile extents as las_files_extents writes them, kept in memory by the local backend
+    out_fc = create_feature_class("memory", f"tile_extents_{num_tiles}", "POLYGON", None)
+    add_field(out_fc, "Id", "LONG")
+    with insert_cursor(out_fc, ["SHAPE@", "Id"]) as cursor:
+        for n, e in enumerate(tile_extents(num_tiles)):
+            cursor.insertRow([[(e.XMin, e.YMin), (e.XMin, e.YMax), (e.XMax, e.YMax), (e.XMax, e.YMin)], n])
+    return out_fc
+
+
+def tile_grid(extents):
+    # Feature bounds from the tile extents, then the grid, as in gen_tile_grid
+    return grid_bounds(*extents_bounds(extents), splits_for_target(len(extents), 1))
+
+
+def quadtree_samples(num_tiles):
+    rng = np.random.default_rng(0)
+    side = 1000 * sqrt(num_tiles)
+    return side, rng.uniform(0, side, num_tiles * SAMPLES_PER_TILE), rng.uniform(0, side, num_tiles * SAMPLES_PER_TILE)
+
+
+def quadtree(samples):
+    side, x, y = samples
+    return quadtree_bounds([(0, 0), (side, side)], x, y, 1, SAMPLES_PER_TILE * 4, max_depth=12)
+
+
+# Each step builds its synthetic input outside the timing, then runs the helpers the planning code calls
+STEPS = {
+    "las_stats_dedupe": (stats_report, parse_las_files_statistics),
+    "split_tile_ids": (range, lambda ids: split_tile_ids(ids, 16)),
+    "tile_flagging": (tile_paths, flag_tiles),
+    "retile_ids": (lambda n: ({m // 2 for m in range(n)}, range(0, n, 2)), lambda ids: tiles_to_retile(*ids)),
+    "tile_ids": (tile_extents_fc, lambda fc: unique_values(fc, "Id")),
+    "tile_grid": (tile_extents, tile_grid),
+    "quadtree_grid": (quadtree_samples, quadtree),
+}
+
+
+def scaling_exponent(sizes, seconds):
+    xs = [log(s) for s in sizes]
+    ys = [log(max(t, 1e-9)) for t in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    return sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys)) / sum((x - x_mean) ** 2 for x in xs)
+
+
+def run_benchmark(sizes):
+    print(f"{'step':<18}" + "".join(f"{f'{s} tiles':>16}" for s in sizes) + f"{'exponent':>10}")
+    for name, (make_input, step) in STEPS.items():
+        seconds = []
+        for size in sizes:
+            step_input = make_input(size)
+            start = perf_counter()
+            step(step_input)
+            seconds.append(perf_counter() - start)
+        per_tile = "".join(f"{t / s * 1e6:>13.2f} us" for t, s in zip(seconds, sizes))
+        print(f"{name:<18}{per_tile}{scaling_exponent(sizes, seconds):>10.2f}")
+
+
+if __name__ == "__main__":
+    set_backend("local")
+    run_benchmark([int(s) for s in argv[1:]] or DEFAULT_SIZES)
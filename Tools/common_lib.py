@@ -1,12 +1,13 @@
-from arcpy import Exists, Describe, GetMessages, AddMessage, AddError, AddWarning, ExecuteWarning, ExecuteError, da
-from arcpy.management import Delete, AddField, CreateFeatureclass
+from backend import describe, exists, delete, add_message, add_error, search_cursor, insert_cursor, \
+    create_feature_class, add_field
 from os import rename, listdir
 from os.path import splitext, isfile, join, split
 from sys import exc_info
+from math import ceil, sqrt
 
 
 def unitsCalc(inFeature):
-    SpatialRef = Describe(inFeature).spatialReference
+    SpatialRef = describe(inFeature).spatialReference
     obtainunits = SpatialRef.linearUnitName
     try:
         if obtainunits == "Foot_US":
@@ -19,13 +20,19 @@ def unitsCalc(inFeature):
             units = "Meter"
             return units
         if obtainunits not in ["Foot_US", "Foot", "Meter"]:
-            AddError("Units Not Detected on {0} \n Terminating Process".format(inFeature))
+            add_error("Units Not Detected on {0} \n Terminating Process".format(inFeature))
             exit()
     except:
-        AddError("Units Not Detected on {0} \n Terminating Process".format(inFeature))
+        add_error("Units Not Detected on {0} \n Terminating Process".format(inFeature))
         exit()
 
 
+def linear_unit(inFeature, distance):
+    # Linear unit string for GP tool distance parameters, e.g. "0.5 Meters"
+    units = {"Foot": "Feet", "Meter": "Meters"}[unitsCalc(inFeature)]
+    return f"{distance} {units}"
+
+
 def rename_file_extension(data_dir, from_extension, to_extension):
     try:
         files = listdir(data_dir)
@@ -37,29 +44,21 @@ def rename_file_extension(data_dir, from_extension, to_extension):
                     newfile = infilename.replace(from_extension, to_extension)
                     rename(infilename, newfile)
 
-    except ExecuteWarning:
-        print(GetMessages(1))
-        AddWarning(GetMessages(1))
-
-    except ExecuteError:
-        print(GetMessages(2))
-        AddError(GetMessages(2))
-
-    # Return any other type of error
+    # No geoprocessing tools run here, so file system errors are the only ones expected
     except:
         # By default any other errors will be caught here
         #
         e = exc_info()[1]
         print(e.args[0])
-        AddError(e.args[0])
+        add_error(e.args[0])
 
 
 def delete_if_exists(in_feature):
     if isinstance(in_feature, str):
-        if Exists(in_feature):
-            Delete(in_feature)
+        if exists(in_feature):
+            delete(in_feature)
     if isinstance(in_feature, list):
-        [Delete(i) for i in in_feature if Exists(i)]
+        [delete(i) for i in in_feature if exists(i)]
 
 
 def _get_path_info(in_file):
@@ -79,20 +78,29 @@ def _get_path_info(in_file):
         return split(in_file)
 
 
+def _feature_bounds(in_fc):
+    # Combined extent of the features, read from each geometry's extent rather than vertex by vertex
+    extents = []
+    for row in search_cursor(in_fc, ['Id', 'SHAPE@']):
+        add_message(f"Generating Tile Grid Tile {row[0]}")
+        extents.append(row[1].extent)
+    return extents_bounds(extents)
+
+
+def extents_bounds(extents):
+    # (x_min, y_min, x_max, y_max) enclosing a list of geometry or dataset extents
+    return (min(e.XMin for e in extents), min(e.YMin for e in extents), max(e.XMax for e in extents),
+            max(e.YMax for e in extents))
+
+
 def gen_tile_grid(in_fc, num_splits, out_file="Bounds"):
-    x_list = []
-    y_list = []
-    for row in da.SearchCursor(in_fc, ['Id', 'SHAPE@']):
-        AddMessage(f"Generating Tile Grid Tile {row[0]}")
-        array1 = row[1].getPart()
-        for vert in range(row[1].pointCount):
-            pnt = array1.getObject(0).getObject(vert)
-            x_list.append(pnt.X)
-            y_list.append(pnt.Y)
-    x_min = min(x_list)
-    x_max = max(x_list)
-    y_min = min(y_list)
-    y_max = max(y_list)
+    bounds_list = grid_bounds(*_feature_bounds(in_fc), num_splits)
+    if out_file.lower() == "bounds_list":
+        return bounds_list
+    return write_tile_grid(in_fc, bounds_list, out_file)
+
+
+def grid_bounds(x_min, y_min, x_max, y_max, num_splits):
     x_interval = (x_max - x_min) / (num_splits+1)  # Must add 1 to the splits
     y_interval = (y_max - y_min) / (num_splits+1)  # Must add 1 to the splits
 
@@ -118,21 +126,54 @@ def gen_tile_grid(in_fc, num_splits, out_file="Bounds"):
             count += 1
             column_count += 1
         row_count += 1
+    return bounds_list
+
+
+def quadtree_bounds(bounds, x, y, point_weight, max_weight, max_depth=6):
+    # Split bounds ([(x_min, y_min), (x_max, y_max)]) into quadrants until the weight of the sampled points (numpy
+    # arrays x and y, each point standing for point_weight points or bytes) in each cell is at most max_weight
+    (x_min, y_min), (x_max, y_max) = bounds
+    if max_depth == 0 or len(x) * point_weight <= max_weight:
+        return [bounds]
+    x_mid = (x_min + x_max) / 2
+    y_mid = (y_min + y_max) / 2
+    east = x >= x_mid
+    north = y >= y_mid
+    quadrants = [([(x_min, y_min), (x_mid, y_mid)], ~east & ~north), ([(x_min, y_mid), (x_mid, y_max)], ~east & north),
+                 ([(x_mid, y_min), (x_max, y_mid)], east & ~north), ([(x_mid, y_mid), (x_max, y_max)], east & north)]
+    bounds_list = []
+    for quadrant, inside in quadrants:
+        bounds_list += quadtree_bounds(quadrant, x[inside], y[inside], point_weight, max_weight, max_depth - 1)
+    return bounds_list
+
 
+def gen_quadtree_grid(in_fc, x, y, point_weight, max_weight, out_file="Bounds", max_depth=6):
+    # Tile grid that splits dense parts of in_fc further than sparse ones, see quadtree_bounds
+    x_min, y_min, x_max, y_max = _feature_bounds(in_fc)
+    bounds_list = quadtree_bounds([(x_min, y_min), (x_max, y_max)], x, y, point_weight, max_weight, max_depth)
     if out_file.lower() == "bounds_list":
         return bounds_list
+    return write_tile_grid(in_fc, bounds_list, out_file)
+
 
+def splits_for_target(total, target):
+    # Number of splits for gen_tile_grid, which produces (num_splits + 1) ** 2 tiles, so no tile exceeds target
+    if not target or total <= target:
+        return 0
+    return ceil(sqrt(total / target)) - 1
+
+
+def write_tile_grid(in_fc, bounds_list, out_file):
     if ".gdb" in out_file.lower() or "memory" in out_file.lower() or out_file.lower().endswith(".shp"):
-        desc = Describe(in_fc)
+        desc = describe(in_fc)
         delete_if_exists(out_file)
         out_fc_head, out_fc_tail = _get_path_info(out_file)
-        CreateFeatureclass(out_fc_head, out_fc_tail, "POLYGON", None, "DISABLED", "DISABLED", desc.spatialReference, '',
-                           0, 0, 0, out_fc_tail.replace(".shp", ""))
+        create_feature_class(out_fc_head, out_fc_tail, "POLYGON", desc.spatialReference)
         for field in [["Id", "Long"]]:
-            AddField(out_file, field[0], field[1], None, None, None, '', "NON_NULLABLE", "NON_REQUIRED", '')
+            add_field(out_file, field[0], field[1])
         count = 0
 
-        with da.InsertCursor(out_file, ['SHAPE@', 'Id']) as cursor:
+        with insert_cursor(out_file, ['SHAPE@', 'Id']) as cursor:
             for i in bounds_list:
                 x_min = i[0][0]
                 y_min = i[0][1]
@@ -144,17 +185,30 @@ def gen_tile_grid(in_fc, num_splits, out_file="Bounds"):
         return out_file
 
 
+def count_vertices(in_fc):
+    with search_cursor(in_fc, ["SHAPE@"]) as cursor:
+        return sum(row[0].pointCount for row in cursor if row[0])
+
+
 def unique_values(table, field):
-    with da.SearchCursor(table, [field]) as cursor:
+    with search_cursor(table, [field]) as cursor:
         return sorted({row[0] for row in cursor})
 
 
 def extent_of_all_datasets(in_dataset_list):
-    extent_cds = [[Describe(f).extent.XMin, Describe(f).extent.XMax, Describe(f).extent.YMin, Describe(f).extent.YMax]
-                  for f in in_dataset_list]
-    x_min = sorted([i[0] for i in extent_cds])[0]
-    x_max = sorted([i[1] for i in extent_cds])[-1]
-    y_min = sorted([i[2] for i in extent_cds])[0]
-    y_max = sorted([i[3] for i in extent_cds])[-1]
-    print(extent_cds)
+    extents = [describe(f).extent for f in in_dataset_list]
+    x_min, y_min, x_max, y_max = extents_bounds(extents)
+    print([[e.XMin, e.XMax, e.YMin, e.YMax] for e in extents])
     return [x_min, x_max, y_min, y_max]
+
+
+def tile_status(tile_path, updated_paths):
+    # STATUS of a source tile in the plan: Updated for the tiles to clip, Source for the tiles copied as is.
+    # updated_paths is a set, so flagging a catalog is linear in its size.
+    return "Updated" if tile_path in updated_paths else "Source"
+
+
+def tiles_to_retile(clipped_ids, source_ids):
+    # Clipped tile ids that have a source tile extent to re-tile against, highest id first
+    source_ids = set(source_ids)
+    return [my_id for my_id in sorted(clipped_ids, reverse=True) if my_id in source_ids]
@@ -1,6 +1,5 @@
 from arcpy import AddError, AddMessage, Describe, GetParameterAsText
-from las_lib import list_all_las_files_in_directory
-from arcpy.management import CreateLasDataset
+from las_lib import list_all_las_files_in_directory, build_las_dataset
 from arcpy.mp import ArcGISProject
 from pathlib import Path
 
@@ -15,8 +14,7 @@ def create_las_dataset_recursive(in_directory, out_lasd, spatial_reference):
         AddError(f'Error with output lasd formatting. Must end with ".lasd" extension {out_lasd}')
         exit()
     AddMessage("Generating LAS Dataset")
-    CreateLasDataset(files_list, out_lasd, "NO_RECURSION", None, spatial_reference, "COMPUTE_STATS", "ABSOLUTE_PATHS", 
-                     "NO_FILES")
+    build_las_dataset(files_list, out_lasd, spatial_reference)
     try:
         # Add results to the display
         AddMessage('Adding las dataset to contents...')
@@ -1,40 +1,45 @@
-from arcpy.management import LasDatasetStatistics, CreateFeatureclass, Delete, AddField
-from arcpy import Describe, da, Exists, AddMessage, AddError
-from os.path import split, exists
+from backend import describe, exists as dataset_exists, delete, add_message, add_error, insert_cursor, \
+    create_feature_class, add_field, polygon, create_las_dataset, las_dataset_statistics
+from os.path import split
 from os import remove, walk
 from common_lib import _get_path_info
 from pathlib import Path
+from json import dump, load
+from uuid import uuid4
+import numpy as np
+from point_cache import fingerprint, sample_xy, occupancy_runs, read_las_header
+
+FOOTPRINT_SAMPLES = 200000
 
 
 def generate_extent_polygon(in_feature, out_polygon):
-    desc = Describe(in_feature)
+    desc = describe(in_feature)
     extent = desc.extent
     coordinates = [(extent.XMin, extent.YMin), (extent.XMin, extent.YMax), (extent.XMax, extent.YMax), (extent.XMax, extent.YMin)]
     out_fc_head, out_fc_tail = _get_path_info(out_polygon)
-    CreateFeatureclass(out_fc_head, out_fc_tail, "POLYGON", None, "DISABLED", "DISABLED", desc.spatialReference, '', 0,
-                       0, 0, out_fc_tail.replace(".shp", ""))
+    create_feature_class(out_fc_head, out_fc_tail, "POLYGON", desc.spatialReference)
     for field in [["Id", "Long"]]:
-        AddField(out_polygon, field[0], field[1], None, None, None, '', "NON_NULLABLE", "NON_REQUIRED", '')
-    with da.InsertCursor(out_polygon, ['SHAPE@', 'Id']) as cursor:
+        add_field(out_polygon, field[0], field[1])
+    with insert_cursor(out_polygon, ['SHAPE@', 'Id']) as cursor:
         cursor.insertRow([coordinates, 0])
     return out_polygon
 
 
 def check_consistent_sr(in_file1, in_file2):
-    in_file1_sr = Describe(in_file1).spatialReference
-    in_file2_sr = Describe(in_file2).spatialReference
+    in_file1_sr = describe(in_file1).spatialReference
+    in_file2_sr = describe(in_file2).spatialReference
     if in_file1_sr.factoryCode == in_file2_sr.factoryCode:
-        AddMessage(f"Detected Consistent Spatial References Between Datasets: {in_file1_sr.name}")
+        add_message(f"Detected Consistent Spatial References Between Datasets: {in_file1_sr.name}")
     else:
-        AddError(f"Spatial References are not consistent between datasets. \n Reproject the data so both datasets "
+        add_error(f"Spatial References are not consistent between datasets. \n Reproject the data so both datasets "
                  f"share the same Spatial Reference. \n Dataset 1 SR = {in_file1_sr.name} \n Dataset 2 SR = "
                  f"{in_file2_sr.name} \n The process may require LASTools to reproject one datasets Spatial Reference "
                  f"to aligns with the other dataset")
         exit()
     if in_file1_sr.linearUnitName == in_file2_sr.linearUnitName:
-        AddMessage(f"Detected Consistent Linear Units of Measure Between Datasets: {in_file1_sr.linearUnitName}")
+        add_message(f"Detected Consistent Linear Units of Measure Between Datasets: {in_file1_sr.linearUnitName}")
     else:
-        AddError(f"Linear Units of Measure are not consistent between datasets. \n "
+        add_error(f"Linear Units of Measure are not consistent between datasets. \n "
                  f"Reproject the data so both datasets share the same Spatial Reference and the necessary Linear Unit. "
                  f"\n Dataset 1 SR = {in_file1_sr.name} current units: "
                  f"{in_file1_sr.linearUnitName} \n Dataset 2 SR = {in_file2_sr.name} \n "
@@ -42,9 +47,9 @@ def check_consistent_sr(in_file1, in_file2):
                  f"other dataset")
         exit()
     if in_file1_sr.VCS.factoryCode == in_file2_sr.VCS.factoryCode:
-        AddMessage(f"Detected Consistent Vertical Coordinate Systems Between Datasets: {in_file1_sr.VCS.name}")
+        add_message(f"Detected Consistent Vertical Coordinate Systems Between Datasets: {in_file1_sr.VCS.name}")
     else:
-        AddError(f"Vertical Coordinate Systems are not consistent between datasets. \n Reproject the data so both "
+        add_error(f"Vertical Coordinate Systems are not consistent between datasets. \n Reproject the data so both "
                  f"datasets share the same Spatial Reference. \n Dataset 1 SR = {in_file1_sr.VCS.name} "
                  f"{in_file1_sr.VCS.factoryCode} \n Dataset 2 SR = {in_file2_sr.VCS.name} {in_file2_sr.VCS.factoryCode}"
                  f"\n You may be able to simply update the VCS in ArcGIS Pro under for the specific las dataset under "
@@ -62,44 +67,132 @@ def list_all_las_files_in_directory(out_folder):
     return files_list
 
 
+def las_stats_file(las_file):
+    return Path(las_file).with_suffix(".lasx")
+
+
+def build_las_dataset(files_list, out_lasd, spatial_reference):
+    # Statistics are computed by ExtractLas while the points are written and stored in the .lasx next to each file.
+    # Only files without a .lasx (such as the natively thinned tiles) are read again to compute them.
+    create_las_dataset(files_list, out_lasd, spatial_reference, compute_stats=False)
+    las_dataset_statistics(out_lasd)
+    return out_lasd
+
+
+def las_files_size(files_list):
+    # Point count from the LAS/LAZ headers (None if any file has no readable header, e.g. .zlas) and bytes on disk
+    point_count = 0
+    byte_count = 0
+    for las_file in files_list:
+        byte_count += Path(las_file).stat().st_size
+        header = read_las_header(las_file) if point_count is not None else None
+        point_count = point_count + header["point_count"] if header else None
+    return point_count, byte_count
+
+
+def las_files_bounds(files_list):
+    # [las file, x_min, y_min, x_max, y_max, point count] from each header, the values are None for files without a
+    # readable header (e.g. .zlas)
+    rows = []
+    for las_file in files_list:
+        header = read_las_header(las_file)
+        rows.append([las_file] + (header["bounds"][:4] + [header["point_count"]] if header else [None] * 5))
+    return rows
+
+
+def las_files_in_extents(files_bounds, extents):
+    # Rows of las_files_bounds whose bounds intersect any of the (x_min, y_min, x_max, y_max) extents. Files with
+    # unknown bounds are kept.
+    if not extents:
+        return []
+    x_min, y_min, x_max, y_max = np.array(extents, dtype=float).T
+    selected = []
+    for row in files_bounds:
+        b_x_min, b_y_min, b_x_max, b_y_max = row[1:5]
+        if b_x_min is not None and \
+                not np.any((x_min <= b_x_max) & (x_max >= b_x_min) & (y_min <= b_y_max) & (y_max >= b_y_min)):
+            continue
+        selected.append(row)
+    return selected
+
+
 def get_las_tiles_from_lasd(in_lasd):
-    temp_file = f'{Describe(in_lasd).path}\\las_stats_temp.txt'
-    if exists(temp_file):
-        remove(temp_file)
-    LasDatasetStatistics(in_lasd, "SKIP_EXISTING_STATS", temp_file, "LAS_FILES", "COMMA", "DECIMAL_POINT")
-    las_list = []
-    count = 0
+    # Unique name, shard workers list the same las dataset at the same time
+    temp_file = f'{describe(in_lasd).path}\\las_stats_{uuid4().hex}.txt'
+    las_dataset_statistics(in_lasd, temp_file)
     with open(temp_file) as f:
-        for line in f:
-            if count > 1:
-                las_file = line.strip().split(",")[0]
-                if las_file not in las_list:
-                    las_list.append(las_file)
-            count += 1
+        las_list = parse_las_files_statistics(f)
     remove(temp_file)
-    return [x for x in las_list if x]
+    return las_list
+
+
+def parse_las_files_statistics(lines):
+    # Unique las files, in order of first appearance, from a LAS_FILES statistics report. The report lists each file
+    # once per class code, so duplicates are dropped through a dict rather than a list scan.
+    las_files = dict.fromkeys(line.strip().split(",")[0] for count, line in enumerate(lines) if count > 1)
+    return [x for x in las_files if x]
+
+
+def las_file_footprint(las_file, cell_size, cache_folder):
+    # Coarse occupancy mask built from a sample of the points, cached by file fingerprint so it is only built once.
+    # Returns None for formats that can not be read natively (.laz, .zlas).
+    cache_file = Path(cache_folder) / f"{fingerprint(las_file)}_{cell_size}.json"
+    if cache_file.exists():
+        with open(cache_file) as f:
+            return load(f)
+    sample = sample_xy(las_file, FOOTPRINT_SAMPLES)
+    if sample is None or not len(sample[0]):
+        return None
+    x, y, header = sample
+    footprint = {"origin": [float(x.min()), float(y.min())], "cell_size": cell_size,
+                 "runs": occupancy_runs(x, y, x.min(), y.min(), cell_size)}
+    Path(cache_folder).mkdir(parents=True, exist_ok=True)
+    with open(cache_file, "w") as f:
+        dump(footprint, f)
+    return footprint
+
+
+def footprint_polygon(footprint, spatial_reference):
+    x_origin, y_origin = footprint["origin"]
+    cell = footprint["cell_size"]
+    rings = []
+    for row, first_col, last_col in footprint["runs"]:
+        x_min = x_origin + first_col * cell
+        x_max = x_origin + (last_col + 1) * cell
+        y_min = y_origin + row * cell
+        y_max = y_min + cell
+        rings.append([(x_min, y_min), (x_min, y_max), (x_max, y_max), (x_max, y_min)])
+    return polygon(rings, spatial_reference)
 
 
-def las_files_extents(in_lasd, out_fc):
-    sr = Describe(in_lasd).spatialReference
-    if Exists(out_fc):
-        Delete(out_fc)
+def las_files_extents(in_lasd, out_fc, footprint_cell_size=0, footprint_cache=None):
+    sr = describe(in_lasd).spatialReference
+    if dataset_exists(out_fc):
+        delete(out_fc)
     out_fc_head, out_fc_tail = _get_path_info(out_fc)
-    CreateFeatureclass(out_fc_head, out_fc_tail, "POLYGON", None, "DISABLED", "ENABLED", sr, '', 0, 0, 0,
-                       out_fc_tail.replace(".shp", ""))
+    create_feature_class(out_fc_head, out_fc_tail, "POLYGON", sr, has_z=True)
     for field in [["LAS", "STRING"], ["ZMIN", "DOUBLE"], ["ZMAX", "DOUBLE"]]:
-        AddField(out_fc, field[0], field[1], None, None, None, '', "NON_NULLABLE", "NON_REQUIRED", '')
+        add_field(out_fc, field[0], field[1])
     las_files = get_las_tiles_from_lasd(in_lasd)
     extent_list = []
     for _ in las_files:
-        extent = Describe(_).extent
+        extent = describe(_).extent
         extent_list.append([_, extent.XMin, extent.YMin, extent.XMax, extent.YMax, extent.ZMin, extent.ZMax])
     if out_fc.startswith("memory") or out_fc.startswith("in_memory"):  # If processing in "memory" requires adding Id
-        AddField(out_fc, "Id", "LONG", None, None, None, '', "NON_NULLABLE", "NON_REQUIRED", '')
-    with da.InsertCursor(out_fc, ['SHAPE@', 'SHAPE@Z', 'LAS', 'ZMIN', 'ZMAX', 'Id']) as cursor:
+        add_field(out_fc, "Id", "LONG")
+    tight_count = 0
+    with insert_cursor(out_fc, ['SHAPE@', 'SHAPE@Z', 'LAS', 'ZMIN', 'ZMAX', 'Id']) as cursor:
         count = 0
         for i in extent_list:
             coordinates = [(i[1], i[2]), (i[1], i[4]), (i[3], i[4]), (i[3], i[2])]
+            if footprint_cell_size:  # Use the tight footprint of the points in place of the header bounding box
+                footprint = las_file_footprint(i[0], footprint_cell_size, footprint_cache)
+                if footprint and footprint["runs"]:
+                    coordinates = footprint_polygon(footprint, sr)
+                    tight_count += 1
             cursor.insertRow([coordinates, i[5], i[0], i[5], i[6], count])
             count += 1
+    if footprint_cell_size:
+        add_message(f"Built tight footprints for {tight_count} of {len(extent_list)} las files, the remaining files "
+                   f"use their header extents")
     return out_fc
@@ -0,0 +1,173 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from os.path import getsize, isfile
+from shutil import copyfile
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+# Staged tile pipeline. Reads for the next tiles and writes of the previous ones run on background threads while the
+# calling thread processes the current tile. Geoprocessing tools, cursors and messages must stay on the calling
+# thread, so the stages only run plain Python file and numpy work: warming the OS file cache ahead of a clip, loading
+# cached point columns and copying finished tiles. Queues are bounded by the pipeline depth, so at most depth tiles
+# are read ahead and at most depth writes wait behind the one in progress.
+
+PIPELINE_DEPTH = 2
+PREFETCH_CHUNK = 8 * 1024 ** 2
+
+
+class StageMetrics:
+    """Busy time, items and bytes of each pipeline stage and the time the calling thread spent waiting on them"""
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.stages = {}
+        self.waits = {}
+        self._lock = Lock()
+
+    def record(self, stage, seconds, nbytes=0):
+        with self._lock:
+            totals = self.stages.setdefault(stage, {"items": 0, "seconds": 0.0, "bytes": 0})
+            totals["items"] += 1
+            totals["seconds"] += seconds
+            totals["bytes"] += nbytes
+
+    def record_wait(self, stage, seconds):
+        with self._lock:
+            self.waits[stage] = self.waits.get(stage, 0.0) + seconds
+
+    def summary(self):
+        # Utilization is the share of the wall time a stage was busy. The process stage is whatever the calling thread
+        # did while not waiting on the other stages.
+        wall = perf_counter() - self.start
+        stages = {name: dict(totals) for name, totals in self.stages.items()}
+        stages["process"] = {"items": None, "seconds": max(0.0, wall - sum(self.waits.values())), "bytes": 0}
+        for name, totals in stages.items():
+            totals["utilization"] = totals["seconds"] / wall if wall else 0.0
+            totals["wait_seconds"] = self.waits.get(name, 0.0)
+        return {"wall_seconds": wall, "stages": stages}
+
+
+def describe_stages(summary):
+    lines = []
+    for name, totals in summary["stages"].items():
+        line = f"Pipeline {name}: {totals['seconds']:.1f} s busy ({100 * totals['utilization']:.0f}% of " \
+               f"{summary['wall_seconds']:.1f} s)"
+        if totals["items"]:
+            line += f", {totals['items']} items, {totals['bytes'] / 1024 ** 2:.1f} MB"
+        if totals["wait_seconds"]:
+            line += f", processing waited {totals['wait_seconds']:.1f} s"
+        lines.append(line)
+    return lines
+
+
+def _timed_read(metrics, read, item):
+    start = perf_counter()
+    payload, nbytes = read(item)
+    metrics.record("read", perf_counter() - start, nbytes)
+    return payload
+
+
+def _timed_write(metrics, write, args):
+    start = perf_counter()
+    nbytes = write(*args)
+    metrics.record("write", perf_counter() - start, nbytes or 0)
+
+
+def staged_reads(items, read, metrics, depth=PIPELINE_DEPTH):
+    # Yields (item, payload) in order, where read(item) returns (payload, bytes read). Items are pulled from the
+    # iterator on the calling thread, so it can be a cursor, and read runs up to depth items ahead on a background
+    # thread. A depth of 0 reads each item inline.
+    if depth < 1:
+        for item in items:
+            yield item, _timed_read(metrics, read, item)
+        return
+    iterator = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline_read") as pool:
+        def read_ahead():
+            while len(pending) <= depth:
+                item = next(iterator, StopIteration)
+                if item is StopIteration:
+                    return
+                pending.append((item, pool.submit(_timed_read, metrics, read, item)))
+
+        read_ahead()
+        while pending:
+            item, future = pending.popleft()
+            wait_start = perf_counter()
+            payload = future.result()
+            metrics.record_wait("read", perf_counter() - wait_start)
+            read_ahead()
+            yield item, payload
+
+
+class StagedWriter:
+    """Run write jobs on a background thread in submission order, blocking once depth jobs are queued"""
+
+    def __init__(self, metrics, depth=PIPELINE_DEPTH):
+        self.metrics = metrics
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pipeline_write") if depth >= 1 else None
+        self._slots = BoundedSemaphore(depth + 1)
+        self._futures = []
+
+    def submit(self, write, *args):
+        # write(*args) returns the bytes written. Errors of earlier jobs are raised here or when the writer closes.
+        if not self._pool:
+            _timed_write(self.metrics, write, args)
+            return
+        wait_start = perf_counter()
+        self._slots.acquire()
+        self.metrics.record_wait("write", perf_counter() - wait_start)
+        future = self._pool.submit(_timed_write, self.metrics, write, args)
+        future.add_done_callback(lambda f: self._slots.release())
+        self._futures.append(future)
+        self._raise_errors(wait=False)
+
+    def _raise_errors(self, wait):
+        futures, self._futures = self._futures, []
+        for future in futures:
+            if wait or future.done():
+                future.result()
+            else:
+                self._futures.append(future)
+
+    def close(self):
+        if self._pool:
+            wait_start = perf_counter()
+            self._pool.shutdown(wait=True)
+            self.metrics.record_wait("write", perf_counter() - wait_start)
+            self._raise_errors(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type and self._pool:  # Let queued writes finish but keep the original error
+            self._pool.shutdown(wait=True)
+            return False
+        self.close()
+        return False
+
+
+def prefetch_files(paths):
+    # Read files sequentially and discard the data, so a geoprocessing tool reading them next finds them in the OS
+    # file cache instead of waiting on network storage
+    nbytes = 0
+    for path in paths:
+        if not path or not isfile(path):
+            continue
+        with open(path, "rb", buffering=0) as f:
+            while True:
+                chunk = f.read(PREFETCH_CHUNK)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+    return None, nbytes
+
+
+def copy_files(pairs):
+    nbytes = 0
+    for source, destination in pairs:
+        copyfile(source, destination)
+        nbytes += getsize(destination)
+    return nbytes
@@ -0,0 +1,384 @@
+from hashlib import sha1
+from json import dump, load
+from os import getpid, replace, stat, utime
+from os.path import abspath
+from pathlib import Path
+from re import findall
+from shutil import rmtree
+from struct import pack_into, unpack_from
+from uuid import uuid4
+import numpy as np
+
+# Columnar point cache for uncompressed LAS files. Each tile is decoded once into one .npy file per attribute, keyed
+# by a fingerprint of the source file. Later runs memory-map only the columns they need instead of parsing the LAS
+# records again. Compressed files (.laz, .zlas) are not decoded and callers fall back to the ArcGIS tools.
+
+COLUMNS = ["x", "y", "z", "classification", "intensity", "return_number", "withheld"]
+CACHE_VERSION = 2  # Part of the fingerprint, so entries built with other columns are rebuilt
+LAS_HEADER_BYTES = 375
+
+
+def read_las_header(las_file):
+    with open(las_file, "rb") as f:
+        header = f.read(LAS_HEADER_BYTES)
+    if header[:4] != b"LASF":
+        return None
+    version = (header[24], header[25])
+    point_format = header[104]
+    info = {
+        "version": version,
+        "header_size": unpack_from("<H", header, 94)[0],
+        "offset_to_points": unpack_from("<I", header, 96)[0],
+        "point_format": point_format & 0x3F,
+        "compressed": bool(point_format & 0x80),  # LAZ flags compression in the high bits of the format id
+        "record_length": unpack_from("<H", header, 105)[0],
+        "point_count": unpack_from("<I", header, 107)[0],
+        "scale": unpack_from("<3d", header, 131),
+        "offset": unpack_from("<3d", header, 155),
+    }
+    max_x, min_x, max_y, min_y, max_z, min_z = unpack_from("<6d", header, 179)
+    info["bounds"] = [min_x, min_y, max_x, max_y, min_z, max_z]
+    if version >= (1, 4) and info["header_size"] >= LAS_HEADER_BYTES:
+        info["point_count"] = unpack_from("<Q", header, 247)[0]
+    return info
+
+
+# Linear units as arcpy names them, by EPSG unit code (GeoTIFF keys) and by WKT unit name
+LINEAR_UNITS = {9001: "Meter", 9002: "Foot", 9003: "Foot_US", "metre": "Meter", "meter": "Meter", "foot": "Foot",
+                "international foot": "Foot", "us survey foot": "Foot_US", "foot_us": "Foot_US"}
+
+
+def _parse_wkt(text):
+    # WKT1 as nested [keyword, value, ...] lists
+    stack = [[]]
+    for token in findall(r'"[^"]*"|[\[\](),]|[^\[\](),"\s]+', text):
+        if token in ("[", "("):
+            node = [stack[-1].pop()]
+            stack[-1].append(node)
+            stack.append(node)
+        elif token in ("]", ")"):
+            stack.pop()
+        elif token != ",":
+            stack[-1].append(token.strip('"'))
+    return stack[0][0] if stack[0] and isinstance(stack[0][0], list) else None
+
+
+def _wkt_child(node, keyword):
+    return next((child for child in node[1:] if isinstance(child, list) and child[0] == keyword), None)
+
+
+def _wkt_system(node):
+    authority = _wkt_child(node, "AUTHORITY")
+    unit = _wkt_child(node, "UNIT")
+    return {"name": node[1], "factoryCode": int(authority[2]) if authority else 0,
+            "linearUnitName": LINEAR_UNITS.get(unit[1].lower(), unit[1]) if unit else ""}
+
+
+def read_las_spatial_reference(las_file, header=None):
+    # Name, EPSG code and linear unit of the horizontal and vertical systems from the OGC WKT or GeoTIFF key VLRs,
+    # None when the file has neither
+    header = header or read_las_header(las_file)
+    if not header:
+        return None
+    with open(las_file, "rb") as f:
+        head = f.read(header["offset_to_points"])
+    vlrs = {}
+    position = header["header_size"]
+    for _ in range(unpack_from("<I", head, 100)[0]):
+        if position + 54 > len(head):
+            break
+        record_id, length = unpack_from("<2H", head, position + 18)
+        vlrs[record_id] = head[position + 54:position + 54 + length]
+        position += 54 + length
+    if 2112 in vlrs:
+        root = _parse_wkt(vlrs[2112].decode("ascii", "ignore").rstrip("\0"))
+        if root:
+            horizontal = next((_wkt_child(root, k) for k in ("PROJCS", "GEOGCS") if _wkt_child(root, k)), root)
+            vertical = _wkt_child(root, "VERT_CS")
+            return {**_wkt_system(horizontal), "VCS": _wkt_system(vertical) if vertical else None}
+    if 34735 in vlrs:
+        keys = vlrs[34735]
+        entries = unpack_from(f"<{4 * unpack_from('<H', keys, 6)[0]}H", keys, 8)
+        values = {key: value for key, location, _, value in zip(*[iter(entries)] * 4) if location == 0}
+        code = values.get(3072) or values.get(2048, 0)  # Projected, else geographic system
+        unit = LINEAR_UNITS.get(values.get(3076, 9001 if 3072 in values else 0), "")
+        vertical = values.get(4096)
+        vcs = {"name": f"EPSG:{vertical}", "factoryCode": vertical, "linearUnitName": ""} if vertical else None
+        return {"name": f"EPSG:{code}", "factoryCode": code, "linearUnitName": unit, "VCS": vcs}
+    return None
+
+
+def _record_dtype(header):
+    # Point formats 6-10 moved the classification to its own byte and widened the return number to 4 bits. Byte 15
+    # holds the withheld flag in both layouts: with the classification before format 6, with the other flags after.
+    classification_offset = 16 if header["point_format"] >= 6 else 15
+    return np.dtype({"names": ["X", "Y", "Z", "intensity", "returns", "classification", "flags"],
+                     "formats": ["<i4", "<i4", "<i4", "<u2", "u1", "u1", "u1"],
+                     "offsets": [0, 4, 8, 12, 14, classification_offset, 15],
+                     "itemsize": header["record_length"]})
+
+
+def read_las_records(las_file, header=None):
+    header = header or read_las_header(las_file)
+    if not header or header["compressed"]:
+        return None
+    return np.memmap(las_file, dtype=_record_dtype(header), mode="r", offset=header["offset_to_points"],
+                     shape=(header["point_count"],))
+
+
+def decode_columns(records, header):
+    scale_x, scale_y, scale_z = header["scale"]
+    offset_x, offset_y, offset_z = header["offset"]
+    return_mask = 0x0F if header["point_format"] >= 6 else 0x07
+    classification_mask = 0xFF if header["point_format"] >= 6 else 0x1F
+    withheld_bit = 0x04 if header["point_format"] >= 6 else 0x80
+    return {
+        "x": records["X"] * scale_x + offset_x,
+        "y": records["Y"] * scale_y + offset_y,
+        "z": records["Z"] * scale_z + offset_z,
+        "classification": records["classification"] & classification_mask,
+        "intensity": np.array(records["intensity"]),
+        "return_number": records["returns"] & return_mask,
+        "withheld": (records["flags"] & withheld_bit) > 0,
+    }
+
+
+def fingerprint(las_file):
+    info = stat(las_file)
+    key = f"{abspath(las_file).lower()}|{info.st_size}|{info.st_mtime_ns}|{CACHE_VERSION}"
+    return sha1(key.encode()).hexdigest()
+
+
+def _folder_size(folder):
+    return sum(f.stat().st_size for f in folder.iterdir() if f.is_file())
+
+
+class PointCache:
+    """Memory-mapped columnar cache of LAS point attributes with least recently used disk space eviction"""
+
+    def __init__(self, cache_folder, max_bytes=50 * 1024 ** 3):
+        self.cache_folder = Path(cache_folder)
+        self.cache_folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def supports(self, las_file):
+        header = read_las_header(las_file)
+        return bool(header) and not header["compressed"]
+
+    def columns(self, las_file, columns=("x", "y", "z")):
+        # Returns read-only memory-mapped arrays, or None if the file can not be decoded natively
+        entry = self.cache_folder / fingerprint(las_file)
+        if not (entry / "meta.json").exists() and not self._build(las_file, entry):
+            return None
+        try:
+            utime(entry / "meta.json")  # Marks the entry as recently used
+            return {c: np.load(entry / f"{c}.npy", mmap_mode="r") for c in columns}
+        except OSError:  # Evicted by another process since the check
+            return None
+
+    def header(self, las_file):
+        entry = self.cache_folder / fingerprint(las_file)
+        if (entry / "meta.json").exists():
+            with open(entry / "meta.json") as f:
+                return load(f)["header"]
+        return read_las_header(las_file)
+
+    def _build(self, las_file, entry):
+        header = read_las_header(las_file)
+        records = read_las_records(las_file, header)
+        if records is None:
+            return False
+        # Build in a scratch folder of this process and rename so concurrent readers never see a partial entry
+        scratch = entry.with_name(f"{entry.name}.{getpid()}.building")
+        if scratch.exists():
+            rmtree(scratch)
+        scratch.mkdir()
+        for name, values in decode_columns(records, header).items():
+            np.save(scratch / f"{name}.npy", values)
+        with open(scratch / "meta.json", "w") as f:
+            dump({"source": abspath(las_file), "header": header}, f)
+        del records
+        if entry.exists() and not (entry / "meta.json").exists():  # Left over by an eviction that did not finish
+            self._discard(entry)
+        try:
+            replace(scratch, entry)
+        except OSError:  # Another process finished the same entry first, or the leftover could not be removed
+            rmtree(scratch, ignore_errors=True)
+        if not (entry / "meta.json").exists():
+            return False
+        self.evict(keep=entry)
+        return True
+
+    def _discard(self, entry):
+        # Rename the entry aside first, so it is gone as a whole even when some of its files can not be deleted yet
+        # (memory-mapped by a reader on Windows). Later evictions delete what is left.
+        trash = entry.with_name(f"{entry.name}.{uuid4().hex}.deleted")
+        try:
+            replace(entry, trash)
+        except OSError:
+            return False
+        rmtree(trash, ignore_errors=True)
+        return True
+
+    def evict(self, keep=None):
+        for trash in self.cache_folder.glob("*.deleted"):
+            rmtree(trash, ignore_errors=True)
+        # Entry folders are named by the fingerprint alone, scratch and discarded folders carry a suffix
+        entries = [e for e in self.cache_folder.iterdir()
+                   if "." not in e.name and (e / "meta.json").exists() and e != keep]
+        sizes = {e: _folder_size(e) for e in entries}
+        total = sum(sizes.values()) + (_folder_size(keep) if keep else 0)
+        for entry in sorted(entries, key=lambda e: (e / "meta.json").stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            if self._discard(entry):
+                total -= sizes[entry]
+
+
+def bin_elevation(x, y, z, x_min, y_max, cell_size, n_cols, n_rows, withheld=None):
+    # Per cell sum and count of Z, row 0 is the top of the raster. Sums from several tiles can be added together.
+    # Withheld points are left out, as the ArcGIS tools do.
+    cols = np.floor((x - x_min) / cell_size).astype(np.int64)
+    rows = np.floor((y_max - y) / cell_size).astype(np.int64)
+    inside = (cols >= 0) & (cols < n_cols) & (rows >= 0) & (rows < n_rows)
+    if withheld is not None:
+        inside &= ~withheld
+    cells = rows[inside] * n_cols + cols[inside]
+    sums = np.bincount(cells, weights=z[inside], minlength=n_cols * n_rows)
+    counts = np.bincount(cells, minlength=n_cols * n_rows)
+    return sums, counts
+
+
+def mean_elevation_grid(sums, counts, n_cols, n_rows, nodata=-9999):
+    grid = np.full(n_cols * n_rows, nodata, dtype=np.float32)
+    occupied = counts > 0
+    grid[occupied] = sums[occupied] / counts[occupied]
+    return grid.reshape(n_rows, n_cols)
+
+
+def fill_voids_linear(grid, nodata=-9999):
+    # LINEAR void fill of LasDatasetToRaster: empty cells are interpolated on a triangulation of the cell centers with
+    # data, cells outside its convex hull stay NoData. Only data cells next to a void shape the triangles covering it,
+    # so the triangulation is built from those.
+    void = grid == nodata
+    if not void.any() or void.all():
+        return grid
+    padded = np.pad(void, 1)
+    near_void = np.zeros_like(void)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            near_void |= padded[1 + dy:1 + dy + void.shape[0], 1 + dx:1 + dx + void.shape[1]]
+    rows, cols = np.nonzero(near_void & ~void)
+    void_rows, void_cols = np.nonzero(void)
+    if len(rows) < 3:
+        return grid
+    from scipy.interpolate import griddata  # scipy ships with ArcGIS Pro, importing it takes about half a second
+    try:
+        filled = griddata(np.column_stack([cols, rows]), grid[rows, cols],
+                          np.column_stack([void_cols, void_rows]), method="linear", fill_value=nodata)
+    except (ValueError, RuntimeError):  # Data cells on a single line can not be triangulated
+        return grid
+    grid = grid.copy()
+    grid[void_rows, void_cols] = filled
+    return grid
+
+
+def sample_xy(las_file, max_samples):
+    # Evenly strided sample of the point coordinates, read straight from the LAS records without building the cache
+    header = read_las_header(las_file)
+    records = read_las_records(las_file, header)
+    if records is None:
+        return None
+    sample = records[::max(1, header["point_count"] // max_samples)]
+    return (sample["X"] * header["scale"][0] + header["offset"][0],
+            sample["Y"] * header["scale"][1] + header["offset"][1], header)
+
+
+def occupancy_runs(x, y, x_min, y_min, cell_size):
+    # Occupied cells of a coarse grid as horizontal runs: [row, first column, last column], row 0 at y_min
+    cols = np.floor((x - x_min) / cell_size).astype(np.int64)
+    rows = np.floor((y - y_min) / cell_size).astype(np.int64)
+    n_cols = int(cols.max()) + 1 if len(cols) else 1
+    codes = np.unique(rows * n_cols + cols)
+    if not len(codes):
+        return []
+    rows, cols = codes // n_cols, codes % n_cols
+    breaks = np.flatnonzero((np.diff(rows) != 0) | (np.diff(cols) != 1)) + 1
+    starts = np.r_[0, breaks]
+    ends = np.r_[breaks - 1, len(codes) - 1]
+    return [[int(rows[s]), int(cols[s]), int(cols[e])] for s, e in zip(starts, ends)]
+
+
+def write_las_subset(in_las, out_las, select):
+    # Write the point records picked by select(records, header) (a slice, mask or index array) of an uncompressed LAS
+    # file, with the header counts and bounds updated. The header and VLRs are copied as is, extended VLRs are
+    # dropped. Returns False for formats that can not be read natively.
+    header = read_las_header(in_las)
+    if not header or header["compressed"]:
+        return False
+    raw = np.memmap(in_las, dtype=np.dtype((np.void, header["record_length"])), mode="r",
+                    offset=header["offset_to_points"], shape=(header["point_count"],))
+    kept = np.array(raw[select(raw.view(_record_dtype(header)), header)])
+    del raw
+    with open(in_las, "rb") as f:
+        head = bytearray(f.read(header["offset_to_points"]))
+    columns = decode_columns(kept.view(_record_dtype(header)), header)
+    count = len(kept)
+    by_return = np.bincount(columns["return_number"], minlength=16)[1:16]
+    legacy = header["point_format"] < 6 and count < 2 ** 32
+    pack_into("<I", head, 107, count if legacy else 0)
+    pack_into("<5I", head, 111, *(int(n) if legacy else 0 for n in by_return[:5]))
+    if count:
+        pack_into("<6d", head, 179, columns["x"].max(), columns["x"].min(), columns["y"].max(), columns["y"].min(),
+                  columns["z"].max(), columns["z"].min())
+    if header["version"] >= (1, 4) and header["header_size"] >= LAS_HEADER_BYTES:
+        pack_into("<QI", head, 235, 0, 0)
+        pack_into("<Q", head, 247, count)
+        pack_into("<15Q", head, 255, *(int(n) for n in by_return))
+    with open(out_las, "wb") as f:
+        f.write(head)
+        f.write(kept.tobytes())
+    return True
+
+
+def decimate_las(in_las, out_las, step):
+    # Every step-th point record
+    return write_las_subset(in_las, out_las, lambda records, header: slice(None, None, max(1, int(step))))
+
+
+def thin_las(las_files, out_files, spacing, method="KEEP_ONE", dimension="3D"):
+    # One point per spacing sized voxel (3D) or column (2D) and classification, so points of one class never replace
+    # points of another. KEEP_ONE keeps the point closest to the voxel center, KEEP_HIGHEST the highest point. The
+    # voxels span all the files, each file keeps its surviving points in their original order. Returns the points
+    # read and written, or None when a file can not be read natively.
+    headers = [read_las_header(f) for f in las_files]
+    records = [read_las_records(f, h) for f, h in zip(las_files, headers)]
+    if any(r is None for r in records):
+        return None
+    columns = [decode_columns(r, h) for r, h in zip(records, headers)]
+    del records
+    x, y, z, classification = (np.concatenate([c[name] for c in columns]) for name in ("x", "y", "z", "classification"))
+    if not len(x):
+        return 0, 0
+    origin = np.array([x.min(), y.min(), z.min()])
+    cells = np.floor((np.column_stack([x, y, z]) - origin) / spacing).astype(np.int64)
+    if dimension == "2D":
+        cells[:, 2] = 0
+    _, voxel = np.unique(np.column_stack([cells, classification]), axis=0, return_inverse=True)
+    if method == "KEEP_HIGHEST":
+        score = -z
+    else:
+        offset = np.column_stack([x, y, z]) - origin - (cells + 0.5) * spacing
+        score = (offset[:, :2] ** 2).sum(axis=1) + (offset[:, 2] ** 2 if dimension == "3D" else 0)
+    order = np.lexsort((score, voxel.ravel()))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = voxel.ravel()[order][1:] != voxel.ravel()[order][:-1]
+    keep = np.zeros(len(x), dtype=bool)
+    keep[order[first]] = True
+    start = 0
+    for las_file, out_las, c in zip(las_files, out_files, columns):
+        kept = keep[start:start + len(c["x"])]
+        start += len(c["x"])
+        if kept.any():
+            write_las_subset(las_file, out_las, lambda records, header: kept)
+    return len(x), int(keep.sum())
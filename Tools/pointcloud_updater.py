@@ -1,22 +1,34 @@
-from arcpy.ddd import ExtractLas
-from arcpy import env, GetParameterAsText, GetParameter, CheckExtension, CheckOutExtension, CheckInExtension, ExecuteError, GetMessages
+from arcpy import env, GetParameterAsText, GetArgumentCount, CheckExtension, CheckOutExtension, CheckInExtension, ExecuteError, GetMessages
 from arcpy.management import Dissolve, Delete, LasPointStatsAsRaster, EliminatePolygonPart, CopyFeatures, GetCount, \
-    PolygonToLine, AddField, CalculateField, DeleteField, RepairGeometry, Sort, CreateLasDataset
-from arcpy.analysis import Intersect, SpatialJoin, Select, Union
+    PolygonToLine, AddField, CalculateField, DeleteField, RepairGeometry, Sort, Merge
+from arcpy.analysis import Intersect, SpatialJoin, Select, Union, Erase
 from arcpy.conversion import RasterToPolygon
 from arcpy.sa import IsNull, ExtractByMask
-from arcpy import da, Describe, AddMessage, AddError, AddWarning, CreateUniqueName
+from arcpy import da, Describe, AddMessage, AddError, AddWarning, CreateUniqueName, Exists
 from arcpy.mp import ArcGISProject
-from las_lib import las_files_extents, generate_extent_polygon, list_all_las_files_in_directory
+from arcpy.cartography import SimplifySharedEdges
+from las_lib import las_files_extents, generate_extent_polygon, list_all_las_files_in_directory, build_las_dataset, \
+    las_stats_file, get_las_tiles_from_lasd, las_files_size, las_files_in_extents, las_files_bounds
+from point_cache import decimate_las, sample_xy, thin_las
+from backend import extract_las
 from os.path import join, dirname, isdir
 from os import replace
 from pathlib import Path
 from re import sub
-from common_lib import delete_if_exists, unitsCalc, gen_tile_grid, unique_values, extent_of_all_datasets
+from common_lib import delete_if_exists, unitsCalc, gen_tile_grid, unique_values, extent_of_all_datasets, \
+    count_vertices, linear_unit, gen_quadtree_grid, splits_for_target, tile_status, tiles_to_retile
 from las_lib import check_consistent_sr
+from pipeline_lib import StageMetrics, StagedWriter, staged_reads, describe_stages, prefetch_files, copy_files, \
+    PIPELINE_DEPTH
+from run_metrics import RunRecord, describe_record
+from shard_lib import split_tile_ids, write_shard_plan, read_shard_plan, claim_shard, complete_shard, \
+    pending_shards, worker_name, Heartbeat, STALE_SECONDS, POLL_SECONDS
 from glob import glob
-from shutil import copyfile, rmtree
+from shutil import rmtree
 from tempfile import gettempdir
+from time import perf_counter, sleep
+from threading import Event
+import numpy as np
 
 
 # error classes
@@ -46,73 +58,206 @@ def rename_las_tiles(tile_folder, source_file_basename="Source", updated_file_ba
         file_extension = Path(f).suffix
         file_name = Path(f).stem
         if file_extension in [".las", ".laz", ".zlas"] and file_extension not in [".lasx"]:
+            new_file = None
             if sub('[^a-zA-Z]+', '', file_name).endswith(source_file_basename):
                 new_file = f"{tile_folder}\\{source_file_basename}_{source_count}{file_extension}"
-                replace(f, new_file)
                 source_count += 1
             elif sub('[^a-zA-Z]+', '', file_name).endswith(updated_file_basename):
                 new_file = f"{tile_folder}\\{updated_file_basename}_{updated_count}{file_extension}"
-                replace(f, new_file)
                 updated_count += 1
-        elif file_extension in ".lasx":  # Delete all .lasx auxillary files
+            if new_file:
+                # Keep the statistics written with the file so the output lasd does not have to recompute them
+                if las_stats_file(f).exists():
+                    replace(las_stats_file(f), las_stats_file(new_file))
+                replace(f, new_file)
+    for f in glob(f"{tile_folder}/*.lasx"):  # Delete orphaned .lasx auxillary files
+        if not any(Path(f).with_suffix(ext).exists() for ext in [".las", ".laz", ".zlas"]):
             Path(f).unlink()
 
 
-def retile_las_grid(in_lasd, out_folder, in_source_tile_extents, in_id, num_splits, spatial_reference):
+FOOTPRINT_CACHE = join(gettempdir(), "las_footprints")
+BOUNDARY_CELL_SIZE = 0.5
+QUADTREE_SAMPLES = 200000
+
+TOOL_PARAMETERS = 21
+
+
+def update_lasd_list(in_update_lasd):
+    # One update las dataset, or several separated by semicolons (a multivalue parameter) ordered oldest to newest
+    if isinstance(in_update_lasd, (list, tuple)):
+        return list(in_update_lasd)
+    return [f.strip().strip("'\"") for f in in_update_lasd.split(";") if f.strip()]
+
+
+def thin_las_clip(in_folder, out_folder, spacing, method, dimension="3D"):
+    # Thin the clipped Updated points to one point per spacing sized voxel (3D) or cell (2D) of each classification
+    # while writing them to the tile folder. ThinLas lets every class compete for the same voxel, which drops ground
+    # points under vegetation, so the voxel hash runs natively on the uncompressed clips.
+    files_list = list_all_las_files_in_directory(in_folder)
+    out_files = [join(out_folder, f"{Path(f).stem}_Updated.las") for f in files_list]
+    points_in, points_out = thin_las(files_list, out_files, spacing, method, dimension)
+    rmtree(in_folder)
+    return points_in, points_out
+
+
+def spacing_from_density(density):
+    # Point spacing that yields the target density in points per square linear unit, when thinning in 2D cells
+    return 1 / density ** 0.5
+
+
+def adaptive_tile_grid(in_fc, out_fc, files_list, target_points, target_bytes, quadtree, num_splits):
+    # Size the retile grid of one tile from the point count in the LAS headers, or from the bytes on disk when a
+    # target size in bytes is set or the headers can not be read (.zlas)
+    point_count, byte_count = las_files_size(files_list)
+    if target_points and point_count is not None:
+        total, target, unit = point_count, target_points, "points"
+    elif target_bytes:
+        total, target, unit = byte_count, target_bytes, "bytes"
+    else:
+        AddWarning(f"Point counts unavailable for {in_fc}, using {num_splits} splits")
+        return gen_tile_grid(in_fc, num_splits, out_fc)
+    if quadtree:
+        # Split the dense parts of the tile further than the sparse ones, using a sample of the points
+        samples = [sample_xy(f, max(1, QUADTREE_SAMPLES // len(files_list))) for f in files_list]
+        if samples and all(samples):
+            x = np.concatenate([sample[0] for sample in samples])
+            y = np.concatenate([sample[1] for sample in samples])
+            if len(x):
+                AddMessage(f"Quadtree re-tiling {total} {unit} into tiles of at most {target} {unit}")
+                return gen_quadtree_grid(in_fc, x, y, total / len(x), target, out_fc)
+    splits = splits_for_target(total, target)
+    AddMessage(f"Re-tiling {total} {unit} with {splits} splits for tiles of at most {target} {unit}")
+    return gen_tile_grid(in_fc, splits, out_fc)
+
+
+def retile_las_grid(in_lasd, out_folder, in_source_tile_extents, in_id, num_splits, spatial_reference,
+                    files_list=None, target_points=0, target_bytes=0, quadtree=False):
     in_memory_geom = "memory/in_memory_geom"
     Select(in_source_tile_extents, in_memory_geom, f"Id = {in_id}")
     in_memory_tiled_geom = "memory/in_memory_tiled_geom"
-    gen_tile_grid(in_memory_geom, num_splits, in_memory_tiled_geom)
+    if files_list and (target_points or target_bytes):
+        adaptive_tile_grid(in_memory_geom, in_memory_tiled_geom, files_list, target_points, target_bytes, quadtree,
+                           num_splits)
+    else:
+        gen_tile_grid(in_memory_geom, num_splits, in_memory_tiled_geom)
     AddMessage(f"Re-Tiling pointclouds for Tile: {in_id}")
     # Use Recursive "ExtractLas" as "TileLas" GP tool won't work correctly
     with da.SearchCursor(in_memory_tiled_geom,
                          ["Id", "SHAPE@"], sql_clause=(None, 'ORDER BY Id DESC')) as tile_cursor:
         for grid_tile in tile_cursor:
             grid_id, grid_geom = grid_tile
-            ExtractLas(in_lasd, out_folder, "DEFAULT", grid_geom, "PROCESS_EXTENT",
-                       f"Updated_{grid_id}", "REMOVE_VLR", "REARRANGE_POINTS", "COMPUTE_STATS", None,
-                       "SAME_AS_INPUT")
+            extract_las(in_lasd, out_folder, grid_geom, f"Updated_{grid_id}")
     delete_if_exists([in_memory_geom, in_memory_tiled_geom])
     return
 
 
+def create_output_lasd(out_folder, out_lasd, sr):
+    AddMessage("Generating LAS Dataset")
+    files_list = list_all_las_files_in_directory(out_folder)
+    build_las_dataset(files_list, out_lasd, sr)
+    try:
+        # Add results to the display
+        AddMessage('Adding las dataset to contents...')
+        aprx = ArcGISProject("CURRENT")
+        for m in aprx.listMaps():
+            if m.mapType == "MAP":
+                m.addDataFromPath(out_lasd)
+            elif m.mapType == "SCENE":
+                m.addDataFromPath(out_lasd)
+    except:
+        pass
+
+
+def prefetch_source_tile(item):
+    # Read stage of the tile pipeline: warm the OS file cache with the source tile a clipped row extracts from
+    count, row = item
+    Id, status, dataset, geom, las = row[:5]
+    if dataset == "Source" and status != "Source":
+        return prefetch_files([las, str(las_stats_file(las))])
+    return None, 0
+
+
+def update_tile_bounds(in_update_lasd):
+    # Header bounds and point counts of the tiles of each update las dataset, for the points_read of the clips
+    return [las_files_bounds(get_las_tiles_from_lasd(update_lasd)) for update_lasd in update_lasd_list(in_update_lasd)]
+
+
+def copy_source_tile(las, out_las_file, stop=None):
+    # Write stage of the tile pipeline: copy an unmodified source tile and its statistics, unless stop was set while
+    # the copy was queued
+    if stop is not None and stop.is_set():
+        return 0
+    pairs = [(las, out_las_file)]
+    if las_stats_file(las).exists():
+        pairs.append((str(las_stats_file(las)), str(las_stats_file(out_las_file))))
+    return copy_files(pairs)
+
+
 def cut_tile(in_source_lasd, in_update_lasd, in_cookie_cutter_fc, in_source_tile_extents, out_folder, out_lasd, retile,
-             num_splits):
+             num_splits, tile_ids=None, thin_spacing=0, thin_method="KEEP_ONE", thin_dimension="3D",
+             copy_source_tiles=True,
+             retile_target_points=0, retile_target_bytes=0, retile_quadtree=False, pipeline_depth=PIPELINE_DEPTH,
+             prefetch_sources=True, stop=None, update_tiles=None):
+    # The clips run on this thread, source tiles for the next rows are read ahead and unmodified tiles are copied in
+    # the background (see pipeline_lib). A preview clips decimated copies, so the tiles named by the plan are not
+    # read ahead there. Setting stop (a threading.Event) ends the run before the next clip or copy and returns None,
+    # a shard worker sets it when another worker has taken its shard over. update_tiles holds update_tile_bounds of
+    # the update las datasets, read once per run, shard workers take it from the plan.
+    stop = stop or Event()
     copied_list = []
     modified_tile_ids = []
     num_features = GetCount(in_cookie_cutter_fc)[0]
     sr = Describe(in_source_lasd).spatialReference
     out_tile_folder = None
     scratch_tile_folder = None
-    id_list = []
-
-    with da.SearchCursor(in_cookie_cutter_fc, ["Id", "STATUS", "DATASET", "SHAPE@", "LAS"],
-                         sql_clause=(None, 'ORDER BY Id DESC')) as cursor:
-        count = 0
+    id_list = set()  # Tiles with clipped output
+    source_tiles_read = set()
+    updated_extents = {}  # Extents of the Updated polygons clipped from each update las dataset
+    clip_stats = {"seconds": 0.0, "vertices": 0}
+    thin_counts = {}
+    if tile_ids is not None:  # Restrict processing to a shard of the plan
+        tile_ids = set(tile_ids)
+    metrics = StageMetrics()
+    # Batch plans record which update las dataset covers each Updated polygon
+    update_lasds = update_lasd_list(in_update_lasd)
+    fields = ["Id", "STATUS", "DATASET", "SHAPE@", "LAS"]
+    if "UPDATE" in [f.name for f in Describe(in_cookie_cutter_fc).fields]:
+        fields.append("UPDATE")
+
+    with da.SearchCursor(in_cookie_cutter_fc, fields, sql_clause=(None, 'ORDER BY Id DESC')) as cursor, \
+            StagedWriter(metrics, pipeline_depth) as writer:
         current_id = 0
-        for row in cursor:
-            Id, status, dataset, geom, las = row
+        rows = ((count, row) for count, row in enumerate(cursor) if tile_ids is None or row[0] in tile_ids)
+        read = prefetch_source_tile if prefetch_sources else lambda item: (None, 0)
+        for (count, row), _ in staged_reads(rows, read, metrics, pipeline_depth):
+            if stop.is_set():
+                return None
+            Id, status, dataset, geom, las = row[:5]
+            update_index = int(row[5] or 0) if len(row) > 5 else 0
+            # Distinct suffixes keep same named tiles of different collects apart in the tile folder
+            update_suffix = f"{update_index}" if len(update_lasds) > 1 else ""
             AddMessage(f"Processing PointCloud Tile: {Id} | Conducting PointCloud Clipping Operations on on shape "
                        f"{count} of {int(num_features)-1}")
             if int(current_id) != int(Id):
                 current_id = int(Id)
             out_tile_folder = f"{out_folder}/tiles/tile_{Id}"
             if dataset == "Source" and status != "Source":
-                if Id not in id_list:
-                    id_list.append(Id)
+                id_list.add(Id)
                 AddMessage(f"Clipped Source Dataset Tile")
                 Path(out_tile_folder).mkdir(parents=True, exist_ok=True)  # Make folder if not exist
                 scratch_tile_folder = out_tile_folder
                 if retile:
                     scratch_tile_folder = f"{out_tile_folder}_scratch"
                     Path(scratch_tile_folder).mkdir(parents=True, exist_ok=True)
-                ExtractLas(in_source_lasd, scratch_tile_folder, "DEFAULT", geom, "PROCESS_EXTENT", f"Source",
-                           "REMOVE_VLR", "REARRANGE_POINTS", "COMPUTE_STATS", None, "SAME_AS_INPUT")
+                clip_start = perf_counter()
+                extract_las(in_source_lasd, scratch_tile_folder, geom, "Source")
+                source_tiles_read.add(las)
+                clip_stats["seconds"] += perf_counter() - clip_start
+                clip_stats["vertices"] += geom.pointCount
                 modified_tile_ids.append(Id)
 
             elif dataset == "Updated" and status != "Source":
-                if Id not in id_list:
-                    id_list.append(Id)
+                id_list.add(Id)
                 AddMessage(f"Clipped Updated Dataset Tile")
                 Path(out_tile_folder).mkdir(parents=True, exist_ok=True)  # Make folder if not exist
                 scratch_tile_folder = out_tile_folder
@@ -120,53 +265,85 @@ def cut_tile(in_source_lasd, in_update_lasd, in_cookie_cutter_fc, in_source_tile
                     scratch_tile_folder = f"{out_tile_folder}_scratch"
                     Path(scratch_tile_folder).mkdir(parents=True, exist_ok=True)
                 Path(scratch_tile_folder).mkdir(parents=True, exist_ok=True)  # Make folder if not exist
-                ExtractLas(in_update_lasd, scratch_tile_folder, "DEFAULT", geom, "PROCESS_EXTENT", f"Updated",
-                           "REMOVE_VLR", "REARRANGE_POINTS", "COMPUTE_STATS", None, "SAME_AS_INPUT")
+                clip_start = perf_counter()
+                if thin_spacing:
+                    thin_folder = f"{out_tile_folder}_thin"
+                    Path(thin_folder).mkdir(parents=True, exist_ok=True)
+                    extract_las(update_lasds[update_index], thin_folder, geom, f"Thin{update_suffix}",
+                                rearrange_points=False, compression="NO_COMPRESSION")
+                    points_in, points_out = thin_las_clip(thin_folder, scratch_tile_folder, thin_spacing, thin_method,
+                                                          thin_dimension)
+                    tile_counts = thin_counts.setdefault(Id, [0, 0])
+                    tile_counts[0] += points_in
+                    tile_counts[1] += points_out
+                else:
+                    extract_las(update_lasds[update_index], scratch_tile_folder, geom, f"Updated{update_suffix}")
+                clip_stats["seconds"] += perf_counter() - clip_start
+                clip_stats["vertices"] += geom.pointCount
                 modified_tile_ids.append(Id)
+                extent = geom.extent
+                updated_extents.setdefault(update_index, []).append((extent.XMin, extent.YMin, extent.XMax,
+                                                                     extent.YMax))
+            elif dataset == "Source" and status == "Source" and not copy_source_tiles:
+                AddMessage(f"Skipped Unmodified Source Tile")
             elif dataset == "Source" and status == "Source":
                 AddMessage(f"Copied Source Tile")
                 file_extension = Path(las).suffix
                 out_las_file = f"{dirname(out_tile_folder)}\\Source_{Id}{file_extension}"
-                copyfile(las, out_las_file)
+                writer.submit(copy_source_tile, las, out_las_file, stop)
                 copied_list.append(las)
             else:
                 AddWarning(f"unknown issue processing file: {las}")
-            count += 1
-    if retile:  # Deal with last feature if retile is enabled
+    if stop.is_set():
+        return None
+    clip_stats["pipeline"] = metrics.summary()
+    for line in describe_stages(clip_stats["pipeline"]):
+        AddMessage(line)
+    for my_id, (points_in, points_out) in sorted(thin_counts.items()):
+        ratio = points_in / points_out if points_out else 0
+        AddMessage(f"Thinned Updated points for Tile {my_id}: {points_in} -> {points_out} ({ratio:.1f}:1 reduction)")
+    if retile and id_list:  # Deal with last feature if retile is enabled
         AddMessage("Begin Re-tiling Processed Data")
-        files_list = list_all_las_files_in_directory(out_folder)
+        if tile_ids is None:
+            files_list = list_all_las_files_in_directory(out_folder)
+        else:  # Other shards may still be writing to the output folder
+            files_list = [f for my_id in sorted(id_list)
+                          for f in list_all_las_files_in_directory(f"{out_folder}/tiles/tile_{my_id}_scratch")]
         temp_lasd = CreateUniqueName('temp.lasd', gettempdir())
-        CreateLasDataset(files_list, temp_lasd, "NO_RECURSION", None, sr, "COMPUTE_STATS", "ABSOLUTE_PATHS", "NO_FILES")
-        id_values = unique_values(in_source_tile_extents, "Id")
-        for my_id in id_list:
-            if my_id in id_values:
-                out_tile_folder = f"{out_folder}/tiles/tile_{my_id}"
-                scratch_tile_folder = f"{out_folder}/tiles/tile_{my_id}_scratch"
-                retile_las_grid(in_lasd=temp_lasd, out_folder=out_tile_folder,
-                                in_source_tile_extents=in_source_tile_extents, in_id=my_id, num_splits=num_splits,
-                                spatial_reference=sr)
+        build_las_dataset(files_list, temp_lasd, sr)
+        for my_id in tiles_to_retile(id_list, unique_values(in_source_tile_extents, "Id")):
+            out_tile_folder = f"{out_folder}/tiles/tile_{my_id}"
+            scratch_tile_folder = f"{out_folder}/tiles/tile_{my_id}_scratch"
+            retile_las_grid(in_lasd=temp_lasd, out_folder=out_tile_folder,
+                            in_source_tile_extents=in_source_tile_extents, in_id=my_id, num_splits=num_splits,
+                            spatial_reference=sr, files_list=list_all_las_files_in_directory(scratch_tile_folder),
+                            target_points=retile_target_points, target_bytes=retile_target_bytes,
+                            quadtree=retile_quadtree)
         rmtree(scratch_tile_folder)
         delete_if_exists(temp_lasd)
     # Rename Tiles
     folders_to_process = [d for d in glob(f"{out_folder}\\tiles\\*") if isdir(d)]
+    if tile_ids is not None:
+        folders_to_process = [f"{out_folder}\\tiles\\tile_{my_id}" for my_id in sorted(id_list)
+                              if isdir(f"{out_folder}\\tiles\\tile_{my_id}")]
     AddMessage("Renaming Resulting Tiles")
     for f in folders_to_process:
         rename_las_tiles(f, source_file_basename="Source", updated_file_basename="Updated")
+    # Points and bytes from the LAS headers, points are None when any tile is .zlas
+    points_read, _ = las_files_size(sorted(source_tiles_read.union(copied_list)))
+    # ExtractLas only reads the update tiles the extents of the Updated polygons reach
+    if update_tiles is None and updated_extents:
+        update_tiles = update_tile_bounds(update_lasds)
+    reached = [row for index, extents in sorted(updated_extents.items())
+               for row in las_files_in_extents(update_tiles[index], extents)]
+    update_points = None if any(row[5] is None for row in reached) else sum(row[5] for row in reached)
+    clip_stats["points_read"] = points_read + update_points if None not in (points_read, update_points) else None
+    clip_stats["points_written"], clip_stats["bytes_written"] = las_files_size(
+        [f for folder in folders_to_process for f in list_all_las_files_in_directory(folder)] + copied_list)
+    clip_stats["tiles"] = len(id_list) + len(copied_list)
     if out_lasd:
-        AddMessage("Generating LAS Dataset")
-        files_list = list_all_las_files_in_directory(out_folder)
-        CreateLasDataset(files_list, out_lasd, "NO_RECURSION", None, sr, "COMPUTE_STATS", "ABSOLUTE_PATHS", "NO_FILES")
-        try:
-            # Add results to the display
-            AddMessage('Adding las dataset to contents...')
-            aprx = ArcGISProject("CURRENT")
-            for m in aprx.listMaps():
-                if m.mapType == "MAP":
-                    m.addDataFromPath(out_lasd)
-                elif m.mapType == "SCENE":
-                    m.addDataFromPath(out_lasd)
-        except:
-            pass
+        create_output_lasd(out_folder, out_lasd, sr)
+    return clip_stats
 
 
 ######################
@@ -174,7 +351,7 @@ def cut_tile(in_source_lasd, in_update_lasd, in_cookie_cutter_fc, in_source_tile
 ####################
 
 
-def las_data_boundary(in_lasd, scratch_folder, out_fc, clipping_geom, simplify=True):
+def las_data_boundary(in_lasd, scratch_folder, out_fc, clipping_geom, simplify=True, cell_size=BOUNDARY_CELL_SIZE):
     # TODO: describe lidar to determine appropriate pixel size
     Path(scratch_folder).mkdir(parents=True, exist_ok=True)
     # Extract actual point-cloud extent from lasd as raster
@@ -182,7 +359,7 @@ def las_data_boundary(in_lasd, scratch_folder, out_fc, clipping_geom, simplify=T
     #    env.extent = clipping_geom
     temp_pt_stats_raster = join(scratch_folder, "temp_pt_stats_raster.tif")
     delete_if_exists(temp_pt_stats_raster)
-    LasPointStatsAsRaster(in_lasd, temp_pt_stats_raster, "INTENSITY_RANGE", "CELLSIZE", 0.5)
+    LasPointStatsAsRaster(in_lasd, temp_pt_stats_raster, "INTENSITY_RANGE", "CELLSIZE", cell_size)
     # Mask Raster by clipping geom if input by user
     out_raster = IsNull(temp_pt_stats_raster)
     if clipping_geom:
@@ -233,6 +410,31 @@ def las_data_boundary(in_lasd, scratch_folder, out_fc, clipping_geom, simplify=T
     return extent_boundary
 
 
+def simplify_cookie_cutter(in_fc, tolerance):
+    # Remove the staircase vertices RasterToPolygon leaves on the boundary. The Source and Updated polygons live in the
+    # same feature class, so SimplifySharedEdges simplifies each shared edge once and both sides stay coincident
+    tolerance = linear_unit(in_fc, tolerance)
+    vertices_before = count_vertices(in_fc)
+    SimplifySharedEdges(in_fc, "POINT_REMOVE", tolerance)
+    RepairGeometry(in_fc, "DELETE_NULL", "OGC")
+    vertices_after = count_vertices(in_fc)
+    reduction = 0
+    if vertices_before:
+        reduction = 100 * (vertices_before - vertices_after) / vertices_before
+    AddMessage(f"Simplified cookie-cutter polygons at {tolerance}: {vertices_before} -> {vertices_after} "
+               f"vertices ({reduction:.1f}% reduction)")
+    return vertices_before, vertices_after
+
+
+def report_clip_savings(clip_stats, vertices_before, vertices_after):
+    # Clip cost is part point I/O and part point-in-polygon testing, only the latter scales with vertex count, so the
+    # clip time is reported next to the vertex reduction rather than extrapolated into a time saving
+    AddMessage(f"Clipped {clip_stats['vertices']} polygon vertices in {clip_stats['seconds']:.1f} seconds")
+    if vertices_before > vertices_after:
+        AddMessage(f"Simplification removed {vertices_before - vertices_after} of {vertices_before} cookie-cutter "
+                   f"vertices before clipping")
+
+
 def check_extents_intersect(file_1, file_2):
     file_1_extent_poly = join("memory", "file_1_extent_poly")
     generate_extent_polygon(file_1, file_1_extent_poly)
@@ -251,52 +453,119 @@ def check_extents_intersect(file_1, file_2):
         exit()
 
 
-def las_tiles_to_update(source_lasd, update_lasd, out_folder, out_lasd=None):
-    source_lasd_geom = join("memory", "source_lasd_geom")
-    delete_if_exists(source_lasd_geom)
-    las_files_extents(in_lasd=source_lasd, out_fc=source_lasd_geom)
-    update_lasd_geom = join("memory", "update_lasd_geom")
-    delete_if_exists(update_lasd_geom)
-    las_files_extents(in_lasd=update_lasd, out_fc=update_lasd_geom)
-    update_lasd_geom_dissolved = join("memory", "update_lasd_geom_dissolved")
-    delete_if_exists(update_lasd_geom_dissolved)
-    Dissolve(update_lasd_geom, update_lasd_geom_dissolved, None, None, "MULTI_PART", "DISSOLVE_LINES")
-    delete_if_exists(update_lasd_geom)
-    intersect_boundary_pre = join("memory", "difference_lasd_tile_bounds")
-    delete_if_exists(intersect_boundary_pre)
-    Intersect([source_lasd_geom, update_lasd_geom_dissolved], intersect_boundary_pre, "ALL", None, "INPUT")
-    delete_if_exists([source_lasd_geom, update_lasd_geom_dissolved])
-    values = [[row[0], row[1]] for row in da.SearchCursor(intersect_boundary_pre, ["Id", "LAS"])]
+def las_tiles_to_update(source_lasd, update_lasd, out_folder, out_lasd=None, footprint_cell_size=0,
+                        footprint_cache=FOOTPRINT_CACHE, source_tile_extents=None):
+    # With a footprint cell size the update collect is represented by the occupied cells of its points rather than the
+    # header bounding boxes of its tiles, so source tiles the update points never reach are copied instead of clipped.
+    # Source tiles keep their full extents as update points anywhere inside them must be merged into them.
+    # Several update las datasets are each intersected with the same source tile extents, built once or passed in.
+    source_lasd_geom = source_tile_extents
+    if not source_lasd_geom:
+        source_lasd_geom = join("memory", "source_lasd_geom")
+        delete_if_exists(source_lasd_geom)
+        las_files_extents(in_lasd=source_lasd, out_fc=source_lasd_geom)
+    tiles = {}
+    for update in update_lasd_list(update_lasd):
+        update_lasd_geom = join("memory", "update_lasd_geom")
+        delete_if_exists(update_lasd_geom)
+        las_files_extents(in_lasd=update, out_fc=update_lasd_geom, footprint_cell_size=footprint_cell_size,
+                          footprint_cache=footprint_cache)
+        update_lasd_geom_dissolved = join("memory", "update_lasd_geom_dissolved")
+        delete_if_exists(update_lasd_geom_dissolved)
+        Dissolve(update_lasd_geom, update_lasd_geom_dissolved, None, None, "MULTI_PART", "DISSOLVE_LINES")
+        delete_if_exists(update_lasd_geom)
+        intersect_boundary_pre = join("memory", "difference_lasd_tile_bounds")
+        delete_if_exists(intersect_boundary_pre)
+        Intersect([source_lasd_geom, update_lasd_geom_dissolved], intersect_boundary_pre, "ALL", None, "INPUT")
+        delete_if_exists(update_lasd_geom_dissolved)
+        tiles.update({row[0]: [row[0], row[1]] for row in da.SearchCursor(intersect_boundary_pre, ["Id", "LAS"])})
+        delete_if_exists(intersect_boundary_pre)
+    if not source_tile_extents:
+        delete_if_exists(source_lasd_geom)
+    values = list(tiles.values())
     AddMessage(f"Detected {len(values)} source tiles to be augmented with updated tiles")
-    delete_if_exists(intersect_boundary_pre)
     return values
 
 
-def generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom):
-    # Ensure las datasets have the same spatial reference
-    check_consistent_sr(in_file1=in_source_lasd, in_file2=in_update_lasd)
-    # Ensure las datasets Extents intersect
-    check_extents_intersect(in_source_lasd, in_update_lasd)
+def combine_update_boundaries(boundaries, out_fc):
+    # Newest collect wins: boundaries are ordered oldest to newest and each keeps only the Updated area no newer
+    # collect covers. Every piece records the index of its collect in the UPDATE field.
+    pieces = []
+    temp_fcs = []
+    covered = None  # Area claimed by the collects processed so far
+    for index in reversed(range(len(boundaries))):
+        updated = join("memory", f"update_boundary_{index}")
+        delete_if_exists(updated)
+        Select(boundaries[index], updated, "DATASET = 'Updated'")
+        temp_fcs.append(updated)
+        piece = updated
+        if covered:
+            piece = join("memory", f"update_piece_{index}")
+            delete_if_exists(piece)
+            Erase(updated, covered, piece)
+            temp_fcs.append(piece)
+        AddField(piece, "UPDATE", "SHORT", None, None, None, '', "NULLABLE", "NON_REQUIRED", '')
+        CalculateField(piece, "UPDATE", index, "PYTHON3")
+        AddMessage(f"Update collect {index} supplies {GetCount(piece)[0]} polygons not covered by newer collects")
+        pieces.append(piece)
+        if index:  # Older collects remain
+            merged = join("memory", f"update_merged_{index}")
+            delete_if_exists(merged)
+            Merge([updated] + ([covered] if covered else []), merged)
+            claimed = join("memory", f"update_claimed_{index}")
+            delete_if_exists(claimed)
+            Dissolve(merged, claimed, None, None, "MULTI_PART", "DISSOLVE_LINES")
+            delete_if_exists(merged)
+            if covered:
+                delete_if_exists(covered)
+            covered = claimed
+    Merge(pieces, out_fc)
+    delete_if_exists(temp_fcs + ([covered] if covered else []))
+    RepairGeometry(out_fc, "DELETE_NULL", "OGC")
+    return out_fc
+
+
+def generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom,
+                                      simplify_tolerance=0, footprint_cell_size=0,
+                                      boundary_cell_size=BOUNDARY_CELL_SIZE):
+    update_lasds = update_lasd_list(in_update_lasd)
+    for update_lasd in update_lasds:
+        # Ensure las datasets have the same spatial reference
+        check_consistent_sr(in_file1=in_source_lasd, in_file2=update_lasd)
+        # Ensure las datasets Extents intersect
+        check_extents_intersect(in_source_lasd, update_lasd)
     # Obtain Polygon Boundary where point-clouds exists in las-dataset for augmenting into source lidar dataset
     lasd_boundary = join(output_folder, "lasd_boundary.shp")
     delete_if_exists(lasd_boundary)
-    las_data_boundary(in_update_lasd, output_folder, lasd_boundary, clipping_geom=update_lasd_clipping_geom,
-                      simplify=True)
-    # Detect the LAS Tiles in the source LiDAR dataset that will be updated.
-    tiles = las_tiles_to_update(in_source_lasd, in_update_lasd, output_folder)
+    if len(update_lasds) == 1:
+        las_data_boundary(update_lasds[0], output_folder, lasd_boundary, clipping_geom=update_lasd_clipping_geom,
+                          simplify=True, cell_size=boundary_cell_size)
+    else:
+        AddMessage(f"Combining the boundaries of {len(update_lasds)} update collects, newest collect first")
+        boundaries = [join(output_folder, f"lasd_boundary_{index}.shp") for index in range(len(update_lasds))]
+        for update_lasd, boundary in zip(update_lasds, boundaries):
+            delete_if_exists(boundary)
+            las_data_boundary(update_lasd, output_folder, boundary, clipping_geom=update_lasd_clipping_geom,
+                              simplify=True, cell_size=boundary_cell_size)
+        combine_update_boundaries(boundaries, lasd_boundary)
+        delete_if_exists(boundaries)
+    # Reduce boundary vertices before the Union so every tile piece inherits the simplified shared edges
+    vertices_before = vertices_after = count_vertices(lasd_boundary)
+    if simplify_tolerance:
+        vertices_before, vertices_after = simplify_cookie_cutter(lasd_boundary, simplify_tolerance)
     source_tile_extents = join(output_folder, "source_tile_extents_clip.shp")
     #source_tile_extents = join("memory", "source_tile_extents")
     delete_if_exists(source_tile_extents)
     las_files_extents(in_lasd=in_source_lasd, out_fc=source_tile_extents)
+    # Detect the LAS Tiles in the source LiDAR dataset that will be updated.
+    tiles = las_tiles_to_update(in_source_lasd, update_lasds, output_folder, footprint_cell_size=footprint_cell_size,
+                                source_tile_extents=source_tile_extents)
     print(f"Process will update {len(tiles)} of {GetCount(source_tile_extents)[0]} tiles")
     AddField(source_tile_extents, "STATUS", "STRING", None, None, None, '', "NULLABLE", "NON_REQUIRED", '')
-    tile_paths_for_processing = [i[1] for i in tiles]
+    tile_paths_for_processing = {i[1] for i in tiles}
     with da.UpdateCursor(source_tile_extents, ["LAS", "STATUS"]) as cursor:
         for row in cursor:
-            if row[0] in tile_paths_for_processing:
-                row[1] = "Updated"
-            else:
-                row[1] = "Source"
+            row[1] = tile_status(row[0], tile_paths_for_processing)
             cursor.updateRow(row)
     processed_tile_extents = join("memory", "processed_tile_extents")
     delete_if_exists(processed_tile_extents)
@@ -311,6 +580,16 @@ def generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd, output_fol
             elif not row[1] or row[1].rstrip() == "":  # Attribute Geometries to not process
                 row[1] = "Source"
                 cursor.updateRow(row)
+    # Sampled footprints can miss sparse update points, any tile the update boundary reaches must still be clipped
+    missed_ids = {row[0] for row in da.SearchCursor(tile_processing_template, ["Id", "STATUS", "DATASET"])
+                  if row[1] == "Source" and row[2] == "Updated"}
+    if missed_ids:
+        AddMessage(f"Adding {len(missed_ids)} tiles reached by the update boundary outside the tile footprints")
+        with da.UpdateCursor(tile_processing_template, ["Id", "STATUS"]) as cursor:
+            for row in cursor:
+                if row[0] in missed_ids:
+                    row[1] = "Updated"
+                    cursor.updateRow(row)
     Delete(processed_tile_extents)
     RepairGeometry(tile_processing_template, "DELETE_NULL", "OGC")
     DeleteField(tile_processing_template, ['FID_lasd_b', 'id_1', 'FID_source'])
@@ -319,12 +598,177 @@ def generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd, output_fol
     delete_if_exists(tile_processing_template_sorted)
     Sort(tile_processing_template, tile_processing_template_sorted, "Id ASCENDING", "UR")
     Delete(tile_processing_template)
-    return tile_processing_template_sorted, source_tile_extents
+    return tile_processing_template_sorted, source_tile_extents, [vertices_before, vertices_after]
+
+
+def load_or_generate_plan(in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom,
+                          simplify_tolerance=0, footprint_cell_size=0, reuse_plan=False):
+    # A plan left in the output folder by a preview run is reused as is, so the full run clips with exactly the
+    # polygons that were reviewed
+    in_cookie_cutter_fc = join(output_folder, "tile_processing_template.shp")
+    in_source_tile_extents = join(output_folder, "source_tile_extents_clip.shp")
+    if reuse_plan and Exists(in_cookie_cutter_fc) and Exists(in_source_tile_extents):
+        AddMessage(f"Reusing PointCloud Cookie Cutter plan {in_cookie_cutter_fc}")
+        return in_cookie_cutter_fc, in_source_tile_extents, [0, 0]
+    return generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom,
+                                             simplify_tolerance, footprint_cell_size)
+
+
+######################
+# Preview Functions
+####################
+
+
+def preview_folder_path(output_folder):
+    # Decimated copies and clipped preview tiles, kept out of the output folder that is gathered into the output lasd
+    return output_folder.rstrip("\\/") + "_preview"
+
+
+def build_preview_lasd(in_lasd, out_folder, step, sr, las_files=None):
+    # Every step-th point of each uncompressed tile (or only of las_files), compressed tiles are referenced at full
+    # resolution
+    Path(out_folder).mkdir(parents=True, exist_ok=True)
+    files_list = []
+    for i, las_file in enumerate(las_files if las_files is not None else get_las_tiles_from_lasd(in_lasd)):
+        preview_file = join(out_folder, f"{i}_{Path(las_file).name}")
+        files_list.append(preview_file if decimate_las(las_file, preview_file, step) else las_file)
+    preview_lasd = join(out_folder, "preview.lasd")
+    delete_if_exists(preview_lasd)
+    return build_las_dataset(files_list, preview_lasd, sr)
+
+
+def pointcloud_preview(in_source_lasd, in_update_lasd, output_folder, output_lasd, update_lasd_clipping_geom,
+                       preview_step, preview_cell_size, simplify_tolerance=0, footprint_cell_size=0):
+    # Runs the full pipeline on decimated copies of the data with a coarser boundary raster. The plan is written to
+    # output_folder against the full resolution source tiles and kept, so the full run can start from it. The preview
+    # is written next to the output folder, never inside it, so its tiles stay out of the output las dataset.
+    preview_folder = preview_folder_path(output_folder)
+    sr = Describe(in_source_lasd).spatialReference
+    AddMessage(f"Building preview las datasets from every {preview_step} point")
+    update_preview_lasd = [build_preview_lasd(update_lasd, join(preview_folder, f"update_{index}"), preview_step, sr)
+                           for index, update_lasd in enumerate(update_lasd_list(in_update_lasd))]
+    in_cookie_cutter_fc, in_source_tile_extents, _ = generate_pointcloud_cookie_cutter(
+        in_source_lasd, update_preview_lasd, output_folder, update_lasd_clipping_geom, simplify_tolerance,
+        footprint_cell_size, boundary_cell_size=preview_cell_size)
+    # Only the source tiles the plan clips are decimated, unmodified tiles are not part of the preview
+    updated_tiles = sorted({row[0] for row in da.SearchCursor(in_cookie_cutter_fc, ["LAS"], "STATUS = 'Updated'")})
+    AddMessage(f"Decimating {len(updated_tiles)} source tiles reached by the updates")
+    source_preview_lasd = build_preview_lasd(in_source_lasd, join(preview_folder, "source"), preview_step, sr,
+                                             updated_tiles)
+    preview_lasd = None
+    if output_lasd:
+        preview_lasd = join(dirname(output_lasd), f"{Path(output_lasd).stem}_preview.lasd")
+    cut_tile(source_preview_lasd, update_preview_lasd, in_cookie_cutter_fc, in_source_tile_extents,
+             join(preview_folder, "output"), preview_lasd, False, 0, copy_source_tiles=False, prefetch_sources=False)
+    AddMessage(f"Preview complete. Review the seams in {preview_lasd or preview_folder} against the cookie-cutter "
+               f"polygons {in_cookie_cutter_fc}, then run the full process with the plan reused.")
+
+
+######################
+# Shard Functions
+####################
+
+
+def plan_shards(in_source_lasd, in_update_lasd, output_folder, retile, number_splits, update_lasd_clipping_geom,
+                num_shards, simplify_tolerance=0, thin_spacing=0, thin_method="KEEP_ONE", footprint_cell_size=0,
+                reuse_plan=False, retile_target_points=0, retile_target_bytes=0, retile_quadtree=False,
+                thin_dimension="3D"):
+    # output_folder must be on storage shared by every worker, the plan and all shard state are kept there
+    in_cookie_cutter_fc, in_source_tile_extents, _ = load_or_generate_plan(
+        in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom, simplify_tolerance,
+        footprint_cell_size, reuse_plan)
+    shards = split_tile_ids(unique_values(in_cookie_cutter_fc, "Id"), num_shards)
+    plan = {"source_lasd": in_source_lasd, "update_lasd": in_update_lasd, "cookie_cutter": in_cookie_cutter_fc,
+            "source_tile_extents": in_source_tile_extents, "retile": retile, "number_splits": number_splits,
+            "thin_spacing": thin_spacing, "thin_method": thin_method, "thin_dimension": thin_dimension,
+            "retile_target_points": retile_target_points, "retile_target_bytes": retile_target_bytes,
+            "retile_quadtree": retile_quadtree, "update_tiles": update_tile_bounds(in_update_lasd)}
+    write_shard_plan(output_folder, shards, plan)
+    AddMessage(f"Planned {len(shards)} shards in {output_folder}. Start a shard worker on each machine, then merge.")
+    return shards
+
+
+def _reset_shard_outputs(out_folder, tile_ids):
+    # Remove partial output left behind by a worker that crashed while holding the shard
+    for my_id in tile_ids:
+        for folder in [f"{out_folder}/tiles/tile_{my_id}", f"{out_folder}/tiles/tile_{my_id}_scratch"]:
+            if isdir(folder):
+                rmtree(folder)
+        for f in glob(f"{out_folder}/tiles/Source_{my_id}.*"):
+            Path(f).unlink()
+
+
+def run_shard_worker(output_folder, record, stale_seconds=STALE_SECONDS, poll_seconds=POLL_SECONDS):
+    plan = read_shard_plan(output_folder)["plan"]
+    worker = worker_name()
+    processed = 0
+    # Shards held by other workers are polled until they complete, a worker that dies leaves a stale lock to take over
+    while pending_shards(output_folder):
+        claim = claim_shard(output_folder, worker, stale_seconds)
+        if not claim:
+            sleep(poll_seconds)
+            continue
+        shard, tile_ids = claim
+        AddMessage(f"Worker {worker} claimed shard {shard} with {len(tile_ids)} tiles")
+        start = perf_counter()
+        with Heartbeat(output_folder, shard, worker) as heartbeat, record.stage("clip") as totals:
+            _reset_shard_outputs(output_folder, tile_ids)
+            clip_stats = cut_tile(plan["source_lasd"], plan["update_lasd"], plan["cookie_cutter"],
+                                  plan["source_tile_extents"], output_folder, None, plan["retile"],
+                                  plan["number_splits"], tile_ids=tile_ids, thin_spacing=plan["thin_spacing"],
+                                  thin_method=plan["thin_method"], thin_dimension=plan.get("thin_dimension", "3D"),
+                                  retile_target_points=plan["retile_target_points"],
+                                  retile_target_bytes=plan["retile_target_bytes"],
+                                  retile_quadtree=plan["retile_quadtree"], stop=heartbeat.lost,
+                                  update_tiles=plan.get("update_tiles"))
+            if clip_stats:
+                record_clip_stats(record, totals, clip_stats)
+        if clip_stats and complete_shard(output_folder, shard, worker, perf_counter() - start):
+            processed += 1
+        else:
+            AddWarning(f"Shard {shard} was taken over by another worker as stale, its output is left to that worker")
+    AddMessage(f"Worker {worker} processed {processed} shards, all shards are complete")
+
+
+def record_clip_stats(record, totals, clip_stats):
+    totals["points"] = clip_stats["points_written"]
+    totals["bytes"] = clip_stats["bytes_written"]
+    totals["items"] = clip_stats["tiles"]
+    record.add("points_read", clip_stats["points_read"])
+    record.add("points_written", clip_stats["points_written"])
+    record.add_pipeline(clip_stats["pipeline"])
+
+
+def run_record_path(output_folder, mode, run_record_file=""):
+    # Shard workers share the output folder, so each writes its own record
+    if run_record_file:
+        return run_record_file
+    if mode == "SHARD_WORKER":
+        return join(output_folder, f"run_record_shard_worker_{worker_name()}.json")
+    return join(output_folder, f"run_record_{mode.lower()}.json")
+
+
+def merge_shards(output_folder, output_lasd):
+    pending = pending_shards(output_folder)
+    if pending:
+        AddError(f"Cannot merge, shards {', '.join(pending)} have not completed")
+        exit()
+    plan = read_shard_plan(output_folder)["plan"]
+    create_output_lasd(output_folder, output_lasd, Describe(plan["source_lasd"]).spatialReference)
+    delete_if_exists([plan["cookie_cutter"], plan["source_tile_extents"]])
 
 
 def pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_lasd, retile, number_splits,
-                       update_lasd_clipping_geom):
+                       update_lasd_clipping_geom, simplify_tolerance=0, mode="FULL", num_shards=1, thin_spacing=0,
+                       thin_method="KEEP_ONE", footprint_cell_size=0, reuse_plan=False, preview_step=10,
+                       preview_cell_size=2.0, retile_target_points=0, retile_target_bytes=0, retile_quadtree=False,
+                       run_record_file="", thin_dimension="3D"):
     ext_list = ["3D", "Spatial"]
+    # Resource accounting for the run, scratch folders count towards the temp disk high water mark
+    record = RunRecord(f"pointcloud_updater {mode}", [join(output_folder, "tiles", "*_scratch"),
+                                                      join(output_folder, "tiles", "*_thin"),
+                                                      preview_folder_path(output_folder)],
+                       exclude=[FOOTPRINT_CACHE]).start()
     try:
         for ext in ext_list:
             if CheckExtension(ext) == "Available":
@@ -332,12 +776,37 @@ def pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_las
             else:
                 raise LicenseError
 
-        in_cookie_cutter_fc, in_source_tile_extents = generate_pointcloud_cookie_cutter(in_source_lasd, in_update_lasd,
-                                                                                        output_folder,
-                                                                                        update_lasd_clipping_geom)
-        cut_tile(in_source_lasd, in_update_lasd, in_cookie_cutter_fc, in_source_tile_extents, output_folder, output_lasd,
-                 retile, number_splits)
-        delete_if_exists([in_cookie_cutter_fc, in_source_tile_extents])
+        if mode == "PLAN_SHARDS":
+            with record.stage("plan"):
+                plan_shards(in_source_lasd, in_update_lasd, output_folder, retile, number_splits,
+                            update_lasd_clipping_geom, num_shards, simplify_tolerance, thin_spacing, thin_method,
+                            footprint_cell_size, reuse_plan, retile_target_points, retile_target_bytes,
+                            retile_quadtree, thin_dimension)
+        elif mode == "PREVIEW":
+            with record.stage("preview"):
+                pointcloud_preview(in_source_lasd, in_update_lasd, output_folder, output_lasd,
+                                   update_lasd_clipping_geom, preview_step, preview_cell_size, simplify_tolerance,
+                                   footprint_cell_size)
+        elif mode == "SHARD_WORKER":
+            run_shard_worker(output_folder, record)
+        elif mode == "MERGE_SHARDS":
+            with record.stage("merge"):
+                merge_shards(output_folder, output_lasd)
+        else:
+            with record.stage("plan"):
+                in_cookie_cutter_fc, in_source_tile_extents, vertex_counts = load_or_generate_plan(
+                    in_source_lasd, in_update_lasd, output_folder, update_lasd_clipping_geom, simplify_tolerance,
+                    footprint_cell_size, reuse_plan)
+            with record.stage("clip") as totals:
+                clip_stats = cut_tile(in_source_lasd, in_update_lasd, in_cookie_cutter_fc, in_source_tile_extents,
+                                      output_folder, output_lasd, retile, number_splits, thin_spacing=thin_spacing,
+                                      thin_method=thin_method, thin_dimension=thin_dimension,
+                                      retile_target_points=retile_target_points,
+                                      retile_target_bytes=retile_target_bytes, retile_quadtree=retile_quadtree)
+                record_clip_stats(record, totals, clip_stats)
+            if simplify_tolerance and not reuse_plan:
+                report_clip_savings(clip_stats, *vertex_counts)
+            delete_if_exists([in_cookie_cutter_fc, in_source_tile_extents])
 
     except LicenseError3D:
         AddError("3D Analyst license is unavailable")
@@ -350,6 +819,44 @@ def pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_las
 
     finally:
         [CheckInExtension(ext) for ext in ext_list]
+        out_record = run_record_path(output_folder, mode, run_record_file)
+        run_record = record.finish(out_record if isdir(dirname(out_record)) else None)
+        for line in describe_record(run_record):
+            AddMessage(line)
+
+
+def run_tool(values):
+    # Parameters as text in toolbox order, the .tbx tool passes fewer than the .pyt tool
+    values = list(values) + [""] * (TOOL_PARAMETERS - len(values))
+    in_source_lasd = values[0]
+    in_update_lasd = values[1]  # Several las datasets separated by ";" run as one batch, oldest first
+    output_folder = values[2]
+    output_lasd = values[3]
+    retile = values[4] == "true"
+    number_splits = int(float(values[5] or 0))
+    update_lasd_clipping_geom = values[6]
+    simplify_tolerance = float(values[7] or 0)  # In the linear units of the las datasets
+    mode = values[8] or "FULL"
+    num_shards = int(values[9] or 1)
+    thin_spacing = float(values[10] or 0)  # Target point spacing in the linear units of the datasets
+    thin_density = float(values[11] or 0)  # Or target points per square linear unit
+    thin_dimension = "3D"
+    if thin_density and not thin_spacing:  # A density is per unit of area, so thin per 2D cell
+        thin_spacing = spacing_from_density(thin_density)
+        thin_dimension = "2D"
+    thin_method = values[12] or "KEEP_ONE"
+    footprint_cell_size = float(values[13] or 0)  # Enables tight tile footprints for tile selection
+    reuse_plan = values[14] == "true"  # Start from the plan of a previous preview run
+    preview_step = int(values[15] or 10)
+    preview_cell_size = float(values[16] or 2.0)
+    retile_target_points = int(float(values[17] or 0))  # Adaptive re-tiling, overrides number_splits when set
+    retile_target_bytes = int(float(values[18] or 0))
+    retile_quadtree = values[19] == "true"
+    run_record_file = values[20]  # Defaults to run_record_<mode>.json in the output folder
+    pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_lasd, retile, number_splits,
+                       update_lasd_clipping_geom, simplify_tolerance, mode, num_shards, thin_spacing, thin_method,
+                       footprint_cell_size, reuse_plan, preview_step, preview_cell_size, retile_target_points,
+                       retile_target_bytes, retile_quadtree, run_record_file, thin_dimension)
 
 
 if __name__ == "__main__":
@@ -363,19 +870,23 @@ if __name__ == "__main__":
         number_splits = 2
         update_lasd_clipping_geom = r''
         # r'C:\Users\geoff.taylor\Documents\ArcGIS\Projects\Boston\Data\Scratch\clipping_geom.shp'
+        simplify_tolerance = 0.5
+        mode = "FULL"  # FULL, PREVIEW, PLAN_SHARDS, SHARD_WORKER or MERGE_SHARDS
+        num_shards = 1
+        thin_spacing = 0
+        thin_method = "KEEP_ONE"  # KEEP_ONE or KEEP_HIGHEST
+        thin_dimension = "3D"  # 3D thins per voxel, 2D per cell
+        footprint_cell_size = 0
+        reuse_plan = False
+        preview_step = 10
+        preview_cell_size = 2.0
+        retile_target_points = 0  # Adaptive re-tiling, overrides number_splits when set
+        retile_target_bytes = 0
+        retile_quadtree = False
+        run_record_file = ""  # Defaults to run_record_<mode>.json in the output folder
         pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_lasd, retile, number_splits,
-                           update_lasd_clipping_geom)
+                           update_lasd_clipping_geom, simplify_tolerance, mode, num_shards, thin_spacing, thin_method,
+                           footprint_cell_size, reuse_plan, preview_step, preview_cell_size, retile_target_points,
+                           retile_target_bytes, retile_quadtree, run_record_file, thin_dimension)
     else:
-        in_source_lasd = GetParameterAsText(0)
-        in_update_lasd = GetParameterAsText(1)
-        output_folder = GetParameterAsText(2)
-        output_lasd = GetParameterAsText(3)
-        retile = GetParameterAsText(4)
-        if retile == "true":
-            retile = True
-        else:
-            retile = False
-        number_splits = int(GetParameter(5))
-        update_lasd_clipping_geom = GetParameterAsText(6)
-        pointcloud_updater(in_source_lasd, in_update_lasd, output_folder, output_lasd, retile, number_splits,
-                           update_lasd_clipping_geom)
+        run_tool([GetParameterAsText(i) for i in range(GetArgumentCount())])
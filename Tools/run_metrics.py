@@ -0,0 +1,287 @@
+# -------------------------------------------------------------------------------
+# Name:        run_metrics.py
+# Purpose:     Resource accounting for tool runs and a regression gate between run records
+#
+# Usage:       python run_metrics.py compare <baseline.json> <run.json> [--threshold 10]
+#
+# A run record holds the peak memory, bytes read and written, points read and written, the temp disk high water mark
+# and the time and throughput of each stage of a run. compare exits with 1 when any metric of the run is worse than
+# the baseline by more than the threshold percentage.
+# -------------------------------------------------------------------------------
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+from datetime import datetime
+from glob import glob
+from importlib import import_module
+from importlib.util import find_spec
+from json import dump, load
+from os import getpid, scandir, walk
+from os.path import isfile, getsize, join, normcase, normpath
+from sys import platform
+from tempfile import gettempdir
+from threading import Event, Thread
+from time import perf_counter, time
+
+# psutil ships with ArcGIS Pro. Without it memory and I/O counters fall back to /proc and resource where available.
+psutil = import_module("psutil") if find_spec("psutil") else None
+
+SAMPLE_SECONDS = 5
+# Lower is better for these run totals, stage throughput is higher is better
+RUN_TOTALS = ["wall_seconds", "peak_rss_bytes", "bytes_read", "bytes_written", "temp_high_water_bytes"]
+
+
+def _proc_io():
+    try:
+        with open(f"/proc/{getpid()}/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def io_bytes():
+    # Bytes read and written by this process so far, or None when the platform does not report them
+    if psutil:
+        counters = psutil.Process().io_counters()
+        return counters.read_bytes, counters.write_bytes
+    return _proc_io()
+
+
+def current_rss():
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        from os import sysconf  # Not available on Windows, where psutil is expected
+        with open(f"/proc/{getpid()}/statm") as f:
+            return int(f.read().split()[1]) * sysconf("SC_PAGE_SIZE")
+    except (ImportError, OSError, ValueError, IndexError):
+        return None
+
+
+def process_peak_rss():
+    # Peak over the life of the process. Tools run inside ArcGIS Pro share its process, so this includes the session.
+    if psutil:
+        info = psutil.Process().memory_info()
+        if hasattr(info, "peak_wset"):
+            return info.peak_wset
+    if find_spec("resource"):
+        resource = import_module("resource")
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if platform == "darwin" else max_rss * 1024
+    return None
+
+
+def folder_size(path):
+    if isfile(path):
+        return getsize(path)
+    total = 0
+    try:
+        with scandir(path) as entries:
+            for entry in entries:
+                try:
+                    total += entry.stat().st_size if entry.is_file() else folder_size(entry.path)
+                except OSError:  # Removed while walking
+                    pass
+    except OSError:
+        pass
+    return total
+
+
+def list_files(paths, exclude=()):
+    # {file: size} of the files and of everything below the folders in paths, skipping the excluded folders
+    exclude = {normcase(normpath(folder)) for folder in exclude}
+    files = {}
+    for path in paths:
+        if isfile(path):
+            walked = [("", [], [path])]
+        elif normcase(normpath(path)) in exclude:
+            continue
+        else:
+            walked = walk(path)
+        for root, folders, names in walked:
+            folders[:] = [f for f in folders if normcase(normpath(join(root, f))) not in exclude]
+            for name in names:
+                try:
+                    files[join(root, name)] = getsize(join(root, name))
+                except OSError:  # Removed while walking
+                    pass
+    return files
+
+
+def top_level_files(folder):
+    # {file: size} of the files directly in folder, its subfolders are not walked
+    files = {}
+    try:
+        with scandir(folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        files[entry.path] = entry.stat().st_size
+                except OSError:  # Removed while listing
+                    pass
+    except OSError:
+        pass
+    return files
+
+
+class RunRecord:
+    """Counters, stage timings and sampled resource usage of one tool run, saved as JSON"""
+
+    def __init__(self, tool, temp_patterns=(), exclude=()):
+        self.tool = tool
+        self.temp_patterns = list(temp_patterns)  # Glob patterns of scratch files and folders
+        self.exclude = [folder for folder in exclude if folder]  # Persistent caches kept in the temp folder
+        self._existing = set()
+        self.stages = {}
+        self.counters = {}
+        self.pipeline = {}
+        self.peak_rss = None
+        self.temp_high_water = 0
+        self._start = None
+        self._start_io = None
+        self._stop = Event()
+        self._sampler = Thread(target=self._sample_loop, daemon=True)
+
+    def start(self):
+        self._start = perf_counter()
+        self._start_time = time()
+        self._start_io = io_bytes()
+        self._existing = set(self._temp_files())
+        self.sample()
+        self._sampler.start()
+        return self
+
+    def _temp_files(self):
+        # The tools write their temporary las datasets and statistics files directly into the temp folder, so only
+        # its top level is listed. A shared temp folder can hold far more below it than a run creates.
+        files = top_level_files(gettempdir())
+        files.update(list_files([path for pattern in self.temp_patterns for path in glob(pattern)], self.exclude))
+        return files
+
+    def temp_bytes(self):
+        # Files created since the run started at the top of the temp folder (temporary las datasets, statistics) and
+        # in the scratch paths matching the tracked patterns. memory/ workspaces live in process memory and show up in
+        # the peak RSS instead.
+        return sum(size for path, size in self._temp_files().items() if path not in self._existing)
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+        self.temp_high_water = max(self.temp_high_water, self.temp_bytes())
+
+    def _sample_loop(self):
+        while not self._stop.wait(SAMPLE_SECONDS):
+            self.sample()
+
+    def add(self, counter, value):
+        # Run level counters, e.g. points_read and points_written
+        if value is not None:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextmanager
+    def stage(self, name):
+        # Times the block. Add the points, bytes or items it handled to the yielded dict for its throughput.
+        totals = {"points": 0, "bytes": 0, "items": 0}
+        start = perf_counter()
+        try:
+            yield totals
+        finally:
+            self.sample()
+            stage = self.stages.setdefault(name, {"seconds": 0.0, "points": 0, "bytes": 0, "items": 0})
+            stage["seconds"] += perf_counter() - start
+            for key in ["points", "bytes", "items"]:
+                stage[key] += totals[key] or 0
+
+    def add_pipeline(self, summary):
+        # Stage utilization reported by pipeline_lib
+        self.pipeline = summary
+
+    def finish(self, out_file=None):
+        self._stop.set()
+        if self._sampler.is_alive():
+            self._sampler.join()
+        self.sample()
+        wall = perf_counter() - self._start
+        end_io = io_bytes()
+        bytes_read = bytes_written = None
+        if self._start_io and end_io:
+            bytes_read, bytes_written = end_io[0] - self._start_io[0], end_io[1] - self._start_io[1]
+        stages = {}
+        for name, stage in self.stages.items():
+            throughput = {f"{unit}_per_second": stage[unit] / stage["seconds"]
+                          for unit in ["points", "bytes", "items"] if stage[unit] and stage["seconds"]}
+            stages[name] = dict(stage, throughput=throughput)
+        record = {"tool": self.tool, "started": datetime.fromtimestamp(self._start_time).isoformat(),
+                  "wall_seconds": wall, "peak_rss_bytes": self.peak_rss, "process_peak_rss_bytes": process_peak_rss(),
+                  "bytes_read": bytes_read, "bytes_written": bytes_written,
+                  "temp_high_water_bytes": self.temp_high_water, "counters": self.counters, "stages": stages,
+                  "pipeline": self.pipeline}
+        if out_file:
+            with open(out_file, "w") as f:
+                dump(record, f, indent=2)
+        return record
+
+
+def describe_record(record):
+    def mb(value):
+        return "n/a" if value is None else f"{value / 1024 ** 2:.1f} MB"
+    lines = [f"Run {record['wall_seconds']:.1f} s, peak RSS {mb(record['peak_rss_bytes'])}, read "
+             f"{mb(record['bytes_read'])}, written {mb(record['bytes_written'])}, temp disk high water "
+             f"{mb(record['temp_high_water_bytes'])}"]
+    lines += [f"{counter}: {value}" for counter, value in record["counters"].items()]
+    for name, stage in record["stages"].items():
+        rates = ", ".join(f"{rate:.1f} {unit.replace('_', ' ')}" for unit, rate in stage["throughput"].items())
+        lines.append(f"Stage {name}: {stage['seconds']:.1f} s" + (f" ({rates})" if rates else ""))
+    return lines
+
+
+def comparable_metrics(record):
+    # {metric: (value, lower_is_better)}
+    metrics = {name: (record[name], True) for name in RUN_TOTALS if record.get(name) is not None}
+    for name, stage in record["stages"].items():
+        metrics[f"{name}.seconds"] = (stage["seconds"], True)
+        for unit, rate in stage["throughput"].items():
+            metrics[f"{name}.{unit}"] = (rate, False)
+    return metrics
+
+
+def compare_records(baseline, run, threshold):
+    # Metrics of the run worse than the baseline by more than threshold percent, as (metric, baseline, run, change %)
+    regressions = []
+    run_metrics = comparable_metrics(run)
+    for metric, (base_value, lower_is_better) in comparable_metrics(baseline).items():
+        if metric not in run_metrics or not base_value:
+            continue
+        value = run_metrics[metric][0]
+        change = 100 * (value - base_value) / base_value
+        if (change if lower_is_better else -change) > threshold:
+            regressions.append((metric, base_value, value, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Compare a run record against a baseline run record")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compare = commands.add_parser("compare")
+    compare.add_argument("baseline")
+    compare.add_argument("run")
+    compare.add_argument("--threshold", type=float, default=10.0, help="Allowed regression in percent")
+    args = parser.parse_args(argv)
+    with open(args.baseline) as f:
+        baseline = load(f)
+    with open(args.run) as f:
+        run = load(f)
+    regressions = compare_records(baseline, run, args.threshold)
+    for metric, base_value, value, change in regressions:
+        print(f"REGRESSION {metric}: {base_value:.6g} -> {value:.6g} ({change:+.1f}%)")
+    if regressions:
+        print(f"{len(regressions)} metrics regressed by more than {args.threshold}%")
+        return 1
+    print(f"No metric regressed by more than {args.threshold}%")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
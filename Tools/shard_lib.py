@@ -0,0 +1,193 @@
+from json import dump, load
+from os import open as os_open, getpid, replace, utime, O_CREAT, O_EXCL, O_WRONLY
+from os.path import getmtime
+from pathlib import Path
+from socket import gethostname
+from threading import Event, Thread
+
+# Shard coordination through a shared folder. Every state change is a single atomic file system operation (exclusive
+# create or replace) so workers on different machines never need an external service to agree on ownership. A shard
+# lock is a series of generation numbered files, the highest generation holds the shard and taking over a stale lock
+# is the exclusive create of the next generation, so only one worker can win each takeover.
+
+SHARD_FOLDER = "shards"
+STALE_SECONDS = 1800
+HEARTBEAT_SECONDS = 60
+POLL_SECONDS = 60
+
+
+def worker_name():
+    return f"{gethostname()}_{getpid()}"
+
+
+def _shard_folder(shared_folder):
+    return Path(shared_folder) / SHARD_FOLDER
+
+
+def _write_json_atomic(out_file, content):
+    temp_file = out_file.with_name(f"{out_file.name}.{worker_name()}.tmp")
+    with open(temp_file, "w") as f:
+        dump(content, f, indent=2)
+    replace(temp_file, out_file)
+
+
+def _shared_now(shared_folder):
+    # Compare lock ages against the clock of the file server rather than the local clock of each worker
+    probe = _shard_folder(shared_folder) / f"clock_{worker_name()}.probe"
+    probe.touch()
+    now = getmtime(probe)
+    probe.unlink()
+    return now
+
+
+def split_tile_ids(tile_ids, num_shards):
+    # Contiguous runs of sorted tile ids keep neighbouring tiles on the same worker
+    ids = sorted(set(tile_ids))
+    num_shards = max(1, min(int(num_shards), len(ids)))
+    size, extra = divmod(len(ids), num_shards)
+    shards = []
+    start = 0
+    for n in range(num_shards):
+        end = start + size + (1 if n < extra else 0)
+        shards.append(ids[start:end])
+        start = end
+    return shards
+
+
+def write_shard_plan(shared_folder, shards, plan):
+    folder = _shard_folder(shared_folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for f in folder.glob("shard_*"):  # Clear state left from a previous plan
+        f.unlink()
+    manifest = {"plan": plan, "shards": {str(n): ids for n, ids in enumerate(shards)}}
+    _write_json_atomic(folder / "manifest.json", manifest)
+    return manifest
+
+
+def read_shard_plan(shared_folder):
+    with open(_shard_folder(shared_folder) / "manifest.json") as f:
+        return load(f)
+
+
+def _lock_file(shared_folder, shard, generation):
+    return _shard_folder(shared_folder) / f"shard_{shard}.lock.{generation}"
+
+
+def _lock_generations(shared_folder, shard):
+    prefix = f"shard_{shard}.lock."
+    generations = [lock.name[len(prefix):] for lock in _shard_folder(shared_folder).glob(f"{prefix}*")]
+    return sorted(int(generation) for generation in generations if generation.isdigit())
+
+
+def _done_file(shared_folder, shard):
+    return _shard_folder(shared_folder) / f"shard_{shard}.done"
+
+
+def _try_lock(lock, worker):
+    try:
+        fd = os_open(lock, O_CREAT | O_EXCL | O_WRONLY)
+    except FileExistsError:
+        return False
+    with open(fd, "w") as f:
+        f.write(worker)
+    return True
+
+
+def _lock_owner(lock):
+    try:
+        return lock.read_text()
+    except OSError:
+        return None
+
+
+def _owned_lock(shared_folder, shard, worker):
+    # The lock of the shard if its current generation belongs to worker
+    generations = _lock_generations(shared_folder, shard)
+    if not generations:
+        return None
+    lock = _lock_file(shared_folder, shard, generations[-1])
+    return lock if _lock_owner(lock) == worker else None
+
+
+def _is_stale(lock, now, stale_seconds):
+    try:
+        return now - getmtime(lock) >= stale_seconds
+    except FileNotFoundError:
+        return False
+
+
+def _try_claim(shared_folder, shard, worker, now, stale_seconds):
+    generations = _lock_generations(shared_folder, shard)
+    current = _lock_file(shared_folder, shard, generations[-1]) if generations else None
+    if current and not _is_stale(current, now, stale_seconds):
+        return False
+    lock = _lock_file(shared_folder, shard, generations[-1] + 1 if generations else 0)
+    if not _try_lock(lock, worker):
+        return False
+    # Give the generation back if the holder refreshed its lock after the check, or completed the shard meanwhile
+    if (current and not _is_stale(current, now, stale_seconds) and current.exists()) or \
+            _done_file(shared_folder, shard).exists() or _owned_lock(shared_folder, shard, worker) != lock:
+        if _lock_owner(lock) == worker:
+            lock.unlink()
+        return False
+    return True
+
+
+def claim_shard(shared_folder, worker, stale_seconds=STALE_SECONDS):
+    manifest = read_shard_plan(shared_folder)
+    now = _shared_now(shared_folder)
+    for shard, tile_ids in manifest["shards"].items():
+        if _done_file(shared_folder, shard).exists():
+            continue
+        if _try_claim(shared_folder, shard, worker, now, stale_seconds):
+            return shard, tile_ids
+    return None
+
+
+def complete_shard(shared_folder, shard, worker, seconds):
+    # Returns False without marking the shard done when another worker took it over as stale in the meantime
+    if not _owned_lock(shared_folder, shard, worker):
+        return False
+    _write_json_atomic(_done_file(shared_folder, shard), {"worker": worker, "seconds": seconds})
+    for generation in _lock_generations(shared_folder, shard):
+        _lock_file(shared_folder, shard, generation).unlink(missing_ok=True)
+    return True
+
+
+def pending_shards(shared_folder):
+    manifest = read_shard_plan(shared_folder)
+    return [shard for shard in manifest["shards"] if not _done_file(shared_folder, shard).exists()]
+
+
+class Heartbeat:
+    """Refresh the lock of a claimed shard in the background so other workers do not treat it as stale"""
+
+    def __init__(self, shared_folder, shard, worker, interval=HEARTBEAT_SECONDS):
+        self.shared_folder = shared_folder
+        self.shard = shard
+        self.worker = worker
+        self.lock = _owned_lock(shared_folder, shard, worker)
+        self.interval = interval
+        self.lost = Event()  # Set once another worker holds the shard, the work done for it must stop
+        if not self.lock:
+            self.lost.set()
+        self._stop = Event()
+        self._thread = Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self.lost.is_set() and not self._stop.wait(self.interval):
+            if _owned_lock(self.shared_folder, self.shard, self.worker) != self.lock:  # Taken over as stale
+                self.lost.set()
+                break
+            try:
+                utime(self.lock)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()